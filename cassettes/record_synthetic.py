@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Synthetic Cassette Recorder
+Records the test cassettes against a scripted stand-in for watsonx.
+The replies, tool texts and ids are made up: these files exercise the
+agent code paths offline and are not evidence of real API behaviour.
+Run from the repository root: python cassettes/record_synthetic.py
+"""
+
+import os
+import sys
+from typing import Any
+from unittest.mock import MagicMock
+
+import ibm_watsonx_ai
+import ibm_watsonx_ai.foundation_models.utils as foundation_utils
+import langchain_ibm
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+CASSETTE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CASSETTE_DIR))
+
+from medbot import gen_ai_service
+
+SORE_THROAT = "I have had a sore throat and a mild fever since yesterday"
+FOLLOW_UP = "How long will it usually last?"
+FINAL_ANSWER = "**Possible causes**\n1. **Viral pharyngitis** (most common) - Urgency: mild\n2. **Strep throat** - Urgency: moderate\n\nRest, drink warm fluids and gargle with salt water. See a doctor if it lasts more than a week or you have trouble swallowing."
+TOOL_OUTPUTS = {
+    "Wikipedia": "Page: Sore throat\nSummary: A sore throat (pharyngitis) is pain or irritation of the throat, usually caused by a viral infection such as the common cold or flu. Strep throat is a bacterial cause. Treatment includes rest, fluids, warm salt water gargles and pain relievers.",
+    "GoogleSearch": "WHO: Seasonal influenza activity is increasing. Symptoms include fever, cough and sore throat."
+}
+USAGE = {"input_tokens": 900, "output_tokens": 60, "total_tokens": 960}
+
+class SyntheticAPIClient:
+    """Stands in for APIClient; the service subclasses it for pooled clients"""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.set = MagicMock()
+
+class SyntheticTool(dict):
+    """Toolkit tool with placeholder definitions and canned outputs"""
+
+    def __init__(self, name):
+        schema = None
+        if name == "Weather":
+            schema = {"type": "object", "properties": {"name": {"type": "string", "description": "City name"}}, "required": ["name"]}
+        super().__init__(description=f"{name} utility tool", agent_description=f"Use {name} to look things up.", input_schema=schema)
+        self.name = name
+
+    def run(self, input, config):
+        return {"output": TOOL_OUTPUTS.get(self.name, f"{self.name} result for {input}")}
+
+class SyntheticToolkit:
+    def __init__(self, api_client=None):
+        pass
+
+    def get_tool(self, name):
+        return SyntheticTool(name)
+
+class ScriptedChatWatsonx(BaseChatModel):
+    """Calls Wikipedia once when it is bound, then answers"""
+    model_id: str = ""
+    url: Any = None
+    space_id: Any = None
+    params: Any = None
+    watsonx_client: Any = None
+
+    @property
+    def _llm_type(self):
+        return "scripted-watsonx"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _reply(self, messages, kwargs):
+        # Like the chat API, refuse tool calls left without a tool response
+        answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+        if any(call["id"] not in answered for m in messages if isinstance(m, AIMessage) for call in m.tool_calls):
+            raise ValueError("tool call without a tool response")
+        tools = [tool["function"]["name"] for tool in kwargs.get("tools") or []]
+        if not any(isinstance(m, ToolMessage) for m in messages) and "Wikipedia" in tools:
+            call = {"id": "chatcmpl-tool-1", "type": "function", "function": {"name": "Wikipedia", "arguments": "{\"input\": \"sore throat\"}"}}
+            return "", [{"id": "chatcmpl-tool-1", "name": "Wikipedia", "args": {"input": "sore throat"}}], {"tool_calls": [call]}, "tool_calls"
+        return FINAL_ANSWER, [], {}, "stop"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        content, calls, extra, finish = self._reply(messages, kwargs)
+        message = AIMessage(content=content, tool_calls=calls, additional_kwargs=extra,
+                            response_metadata={"finish_reason": finish, "model_name": self.model_id},
+                            usage_metadata=USAGE)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        content, calls, extra, finish = self._reply(messages, kwargs)
+        if calls:
+            chunks = [AIMessageChunk(content="", additional_kwargs=extra, tool_call_chunks=[
+                {"id": call["id"], "name": call["name"], "args": "{\"input\": \"sore throat\"}", "index": 0} for call in calls
+            ])]
+        else:
+            words = content.split(" ")
+            chunks = [AIMessageChunk(content=word + " ") for word in words[:-1]] + [AIMessageChunk(content=words[-1])]
+        chunks.append(AIMessageChunk(content="", response_metadata={"finish_reason": finish}, usage_metadata=USAGE))
+        for chunk in chunks:
+            generation_chunk = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(generation_chunk.text, chunk=generation_chunk)
+            yield generation_chunk
+
+class RecordingContext:
+    """Minimal request context for recording runs"""
+
+    def __init__(self, messages, headers=None):
+        self.messages = messages
+        self.headers = dict({"X-Ai-Interface": "assistant"}, **(headers or {}))
+
+    def generate_token(self):
+        return "synthetic-token"
+
+    def get_token(self):
+        return "synthetic-token"
+
+    def get_json(self):
+        return {"messages": self.messages}
+
+    def get_headers(self):
+        return self.headers
+
+def record(filename, conversations, headers=None):
+    """Run generate and generate_stream once per conversation in record mode"""
+    path = os.path.join(CASSETTE_DIR, filename)
+    if os.path.exists(path):
+        os.remove(path)
+    generate, generate_stream = gen_ai_service(RecordingContext(conversations[0], headers), params={
+        "space_id": "synthetic-space",
+        "cassette": {"mode": "record", "path": path}
+    })
+    for messages in conversations:
+        context = RecordingContext(messages, headers)
+        generate(context)
+        for _ in generate_stream(context):
+            pass
+    print(f"Recorded {path}")
+
+if __name__ == "__main__":
+    ibm_watsonx_ai.APIClient = SyntheticAPIClient
+    foundation_utils.Toolkit = SyntheticToolkit
+    langchain_ibm.ChatWatsonx = ScriptedChatWatsonx
+
+    first_turn = [{"role": "user", "content": SORE_THROAT}]
+    record("synthetic_sore_throat.jsonl", [first_turn])
+    # Budget runs out after the first tool request, so the forced answer is recorded
+    record("synthetic_sore_throat_budget.jsonl", [first_turn], {"X-Sla-Max-Iterations": "1"})
+    # A follow-up without new symptoms runs on the tool-less graph
+    record("synthetic_follow_up.jsonl", [first_turn, first_turn + [
+        {"role": "assistant", "content": FINAL_ANSWER},
+        {"role": "user", "content": FOLLOW_UP}
+    ]])
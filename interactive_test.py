@@ -6,7 +6,7 @@ This script simulates a conversation with MedBot using mock data
 
 import json
 from unittest.mock import Mock, MagicMock, patch
-from medbot import gen_ai_service
+from medbot import gen_ai_service, match_red_flags, red_flag_guidance
 
 class InteractiveMockContext:
     """Interactive mock context for testing conversations"""
@@ -30,6 +30,16 @@ class InteractiveMockContext:
 
 def create_mock_response(user_message):
     """Create a mock response based on user input"""
+    response = create_keyword_response(user_message)
+    
+    # Red flags use the same rules as the real service
+    red_flags = match_red_flags(user_message)
+    if red_flags:
+        return red_flag_guidance(red_flags) + "\n\n" + response
+    return response
+
+def create_keyword_response(user_message):
+    """Pick a canned response from keywords in the message"""
     user_message_lower = user_message.lower()
     
     # Simple keyword-based responses for testing
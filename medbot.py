@@ -2,16 +2,121 @@ params = {
     "space_id": "a28ef318-04dc-4320-a9e1-6f3a8d6f071e", 
 }
 
+# Red-flag presentations that need emergency care; shared with the mock responders
+red_flag_rules = [
+    {
+        "name": "chest_pain",
+        "patterns": [r"chest (pain|tightness|pressure)", r"pain in (my|the) chest", r"crushing pain"],
+        "guidance": "Chest pain or pressure can be a sign of a heart attack, especially with sweating, nausea or pain spreading to the arm, jaw or back."
+    },
+    {
+        "name": "breathing_difficulty",
+        "patterns": [r"(difficulty|trouble|hard) breathing", r"can'?t breathe", r"can ?not breathe", r"short(ness)? of breath", r"gasping for (air|breath)"],
+        "guidance": "Difficulty breathing or severe shortness of breath needs urgent assessment."
+    },
+    {
+        "name": "thunderclap_headache",
+        "patterns": [r"thunderclap", r"worst headache", r"sudden,? (and )?severe headache"],
+        "guidance": "A sudden, severe \"thunderclap\" headache can signal bleeding in the brain."
+    },
+    {
+        "name": "stroke_signs",
+        "patterns": [r"face (is )?droop", r"slurred speech", r"sudden (weakness|numbness)", r"can'?t (move|feel) (one|my) (side|arm|leg)"],
+        "guidance": "Face drooping, arm weakness or slurred speech are warning signs of a stroke—every minute matters."
+    },
+    {
+        "name": "severe_bleeding",
+        "patterns": [r"(severe|heavy|uncontrolled|won'?t stop) bleeding", r"bleeding (heavily|won'?t stop)", r"(coughing|vomiting|throwing) up blood", r"(coughing|vomiting) blood"],
+        "guidance": "Heavy bleeding or coughing/vomiting blood needs emergency care."
+    },
+    {
+        "name": "anaphylaxis",
+        "patterns": [r"throat (is )?(swelling|closing)", r"swollen (tongue|lips|throat)", r"anaphyla"],
+        "guidance": "Swelling of the throat, tongue or lips can be a severe allergic reaction (anaphylaxis). Use an adrenaline auto-injector if you have one."
+    },
+    {
+        "name": "seizure_or_collapse",
+        "patterns": [r"seizure", r"unconscious", r"passed out", r"fainted", r"unresponsive"],
+        "guidance": "Seizures, fainting or unresponsiveness need immediate medical evaluation."
+    },
+    {
+        "name": "meningitis_signs",
+        "patterns": [r"stiff neck.*fever", r"fever.*stiff neck", r"neck stiffness.*fever", r"fever.*neck stiffness"],
+        "guidance": "Fever with a stiff neck can be a sign of meningitis."
+    },
+    {
+        "name": "self_harm",
+        "patterns": [
+            r"suicid", r"kill myself", r"end(ing)? my (own )?life", r"don'?t want to (live|be alive)",
+            r"(want|wanting|going|plan|planning|trying|tempted|urge) to (hurt|harm|cut|kill) myself",
+            r"(thinking|thought|thoughts) (about|of) (hurting|harming|cutting|killing) myself",
+            r"(been|keep|am|i'?m) (hurting|harming|cutting) myself"
+        ],
+        "guidance": "If you are thinking about harming yourself, please contact a crisis line or someone you trust right now—you don't have to face this alone."
+    }
+]
+
+# Matches are skipped when negated or about past history in the same clause,
+# unless the symptom is described as new ("never had chest pain like this")
+red_flag_guards = {
+    "clause_break": r"[.,;!?]|\b(?:but|and|however|though|although)\b",
+    "negation": r"(\b(no|without|denies|free of|history of|(do|does|did)(n'?t| not) have|(have|has)(n'?t| not) had)\b(\s+\w+){0,3}|\b(not|never)(\s+(been|felt|had|having|getting)(\s+any)?)?)\s*$",
+    "new_onset": r"^\s*(\w+\s+){0,2}(like (this|that)|before|until (now|today))\b",
+    "past": r"^\s*(\w+\s+){0,3}((years?|months?) ago|as a (child|kid|teenager)|in the past|long ago)\b"
+}
+
+red_flag_notice = "**If you are in immediate danger, call your local emergency number (for example 911, 112, 999 or 108) or go to the nearest emergency department now.** Don't wait for the rest of this answer."
+
+
+def match_red_flags(text, rules=red_flag_rules, guards=red_flag_guards):
+    """Return the red-flag rules matching a user message"""
+    import re
+
+    def applies(match):
+        before = re.split(guards["clause_break"], text[:match.start()], flags=re.IGNORECASE)[-1]
+        after = re.split(guards["clause_break"], text[match.end():], flags=re.IGNORECASE)[0]
+        if (re.search(guards["new_onset"], after, re.IGNORECASE)):
+            return True
+        return not (re.search(guards["negation"], before, re.IGNORECASE) or re.search(guards["past"], after, re.IGNORECASE))
+
+    return [
+        rule for rule in rules
+        if any(applies(match) for pattern in rule["patterns"] for match in re.finditer(pattern, text, re.IGNORECASE))
+    ]
+
 
-def gen_ai_service(context, params = params, **custom):
+def red_flag_guidance(matches, notice=red_flag_notice):
+    """Format the emergency guidance shown for matched red-flag rules"""
+    lines = ["⚠️ **Seek Immediate Care**", ""]
+    lines += [f"- {rule['guidance']}" for rule in matches]
+    lines += ["", notice]
+    return "\n".join(lines)
+
+
+def gen_ai_service(context, params = params, red_flag_rules = red_flag_rules, red_flag_guards = red_flag_guards, red_flag_notice = red_flag_notice,
+                   match_red_flags = match_red_flags, red_flag_guidance = red_flag_guidance, **custom):
     # import dependencies
     from langchain_ibm import ChatWatsonx
     from ibm_watsonx_ai import APIClient
     from ibm_watsonx_ai.foundation_models.utils import Tool, Toolkit
-    from langchain_core.messages import AIMessage, HumanMessage
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
     from langgraph.checkpoint.memory import MemorySaver
     from langgraph.prebuilt import create_react_agent
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import OrderedDict, deque
+    from contextlib import contextmanager
+    from functools import wraps
+    import contextvars
+    import inspect
+    import heapq
+    import threading
+    import uuid
+    import sys
+    import os
+    import random
+    import time
     import json
+    import re
     import requests
 
     model = "mistralai/mistral-large"
@@ -23,37 +128,463 @@ def gen_ai_service(context, params = params, **custom):
         "token": context.generate_token()
     }
 
+    # Record/replay of model and tool traffic for offline runs
+    cassette_settings = params.get("cassette") or {}
+    cassette_mode = cassette_settings.get("mode")
+
     # Setup client
-    client = APIClient(credentials)
     space_id = params.get("space_id")
-    client.set.default_space(space_id)
+    if (cassette_mode != "replay"):
+        client = APIClient(credentials)
+        client.set.default_space(space_id)
+
+    # Speculative tool calls started alongside the first LLM call
+    prefetch_executor = ThreadPoolExecutor(max_workers=params.get("prefetch_workers", 4))
+    prefetch_lock = threading.Lock()
+    prefetch_stats = {
+        "issued": 0,
+        "hits": 0,
+        "discarded": 0
+    }
+
+    # Per-request state read by pooled graphs and tools (instructions, prefetched results, caller token)
+    request_context = contextvars.ContextVar("medbot_request", default=None)
+
+    default_parameters = {
+        "frequency_penalty": 0,
+        "max_tokens": 2000,
+        "presence_penalty": 0,
+        "temperature": 0,
+        "top_p": 1
+    }
 
+    def current_request():
+        return request_context.get() or {}
 
+    # On-demand stack sampling of agent runs, kept as collapsed (flamegraph) stacks
+    profile_lock = threading.Lock()
+    active_profiles = []
+    recent_profiles = deque(maxlen=params.get("profile_history", 20))
+    profile_sampler = { "thread": None }
 
-    def create_chat_model(watsonx_client):
-        parameters = {
-            "frequency_penalty": 0,
-            "max_tokens": 2000,
-            "presence_penalty": 0,
-            "temperature": 0,
-            "top_p": 1
+    def profile_requested(payload, headers):
+        if (str((headers or {}).get("X-Profile", "")).lower() in ("1", "true", "yes")):
+            return True
+        if (payload.get("profile") is True):
+            return True
+        return random.random() < params.get("profile_sample_rate", 0.0)
+
+    def start_profile(mode, conversation_id):
+        profile = {
+            "id": uuid.uuid4().hex,
+            "mode": mode,
+            "conversation_id": conversation_id,
+            "started_at": time.time(),
+            "started": time.monotonic(),
+            "threads": {},
+            "stacks": {},
+            "samples": 0
         }
+        with profile_lock:
+            active_profiles.append(profile)
+            if (profile_sampler["thread"] is None):
+                profile_sampler["thread"] = threading.Thread(target=run_profile_sampler, name="medbot-profiler", daemon=True)
+                profile_sampler["thread"].start()
+        return profile
 
-        chat_model = ChatWatsonx(
-            model_id=model,
-            url=service_url,
-            space_id=space_id,
-            params=parameters,
-            watsonx_client=watsonx_client,
-        )
+    @contextmanager
+    def profile_section():
+        # Marks the current thread as working for the profiled request
+        profile = current_request().get("profile")
+        if (profile is None):
+            yield
+            return
+        ident = threading.get_ident()
+        with profile_lock:
+            profile["threads"][ident] = profile["threads"].get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            with profile_lock:
+                profile["threads"][ident] -= 1
+                if (profile["threads"][ident] == 0):
+                    del profile["threads"][ident]
+
+    def profiled(func):
+        if (inspect.isgeneratorfunction(func)):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                with profile_section():
+                    yield from func(*args, **kwargs)
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_section():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def collapse_stack(frame):
+        names = []
+        while frame is not None:
+            names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def run_profile_sampler():
+        interval = params.get("profile_interval_ms", 5) / 1000
+        while True:
+            with profile_lock:
+                if (not active_profiles):
+                    profile_sampler["thread"] = None
+                    return
+                targets = [(profile, list(profile["threads"])) for profile in active_profiles]
+            frames = sys._current_frames()
+            samples = [
+                (profile, collapse_stack(frames[ident]))
+                for profile, idents in targets
+                for ident in idents if ident in frames
+            ]
+            del frames
+            with profile_lock:
+                for profile, stack in samples:
+                    profile["stacks"][stack] = profile["stacks"].get(stack, 0) + 1
+                    profile["samples"] += 1
+            time.sleep(interval)
+
+    def finish_profile(profile):
+        if (profile is None):
+            return
+        with profile_lock:
+            active_profiles.remove(profile)
+            stacks = dict(profile["stacks"])
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items()))
+        record = {
+            "id": profile["id"],
+            "mode": profile["mode"],
+            "conversation_id": profile["conversation_id"],
+            "started_at": profile["started_at"],
+            "duration_ms": round((time.monotonic() - profile["started"]) * 1000, 3),
+            "interval_ms": params.get("profile_interval_ms", 5),
+            "samples": profile["samples"],
+            "collapsed": collapsed
+        }
+        profile_dir = params.get("profile_dir")
+        if (profile_dir):
+            os.makedirs(profile_dir, exist_ok=True)
+            with open(os.path.join(profile_dir, f"{profile['id']}.folded"), "w") as folded:
+                folded.write(collapsed + "\n")
+        with profile_lock:
+            recent_profiles.append(record)
+
+    def profile_report(limit=20):
+        with profile_lock:
+            records = list(recent_profiles)[::-1][:limit]
+        return [
+            { key: value for key, value in record.items() if key != "collapsed" }
+            for record in records
+        ]
+
+    def get_profile(profile_id):
+        with profile_lock:
+            for record in recent_profiles:
+                if (record["id"] == profile_id):
+                    return record["collapsed"]
+        return None
+
+    # Outbound calls are rate limited per quota and served urgent-first
+    priority_ranks = {
+        "urgent": 0,
+        "normal": 1,
+        "background": 2
+    }
+
+    def detect_red_flags(messages):
+        return match_red_flags(last_user_text(messages), red_flag_rules, red_flag_guards)
+
+    def classify_priority(payload, messages):
+        if (payload.get("priority") in priority_ranks):
+            return payload["priority"]
+        if (detect_red_flags(messages)):
+            return "urgent"
+        return "normal"
+
+    def current_priority():
+        return current_request().get("priority", "normal")
+
+    def create_scheduler(name, limits):
+        return {
+            "name": name,
+            "rate": limits.get("rate"),
+            "burst": limits.get("burst", 1),
+            "tokens": limits.get("burst", 1),
+            "updated": time.monotonic(),
+            "condition": threading.Condition(),
+            "waiters": [],
+            "sequence": 0,
+            "stats": {}
+        }
+
+    def acquire_slot(scheduler, priority):
+        # Replays are not paced unless the cassette asks for it
+        if (not scheduler["rate"] or (cassette_mode == "replay" and not cassette_settings.get("pace"))):
+            return
+        started = time.monotonic()
+        condition = scheduler["condition"]
+        with condition:
+            scheduler["sequence"] += 1
+            waiter = (priority_ranks.get(priority, 1), scheduler["sequence"])
+            heapq.heappush(scheduler["waiters"], waiter)
+            while True:
+                now = time.monotonic()
+                scheduler["tokens"] = min(scheduler["burst"], scheduler["tokens"] + (now - scheduler["updated"]) * scheduler["rate"])
+                scheduler["updated"] = now
+                if (scheduler["waiters"][0] == waiter and scheduler["tokens"] >= 1):
+                    heapq.heappop(scheduler["waiters"])
+                    scheduler["tokens"] -= 1
+                    condition.notify_all()
+                    break
+                if (scheduler["waiters"][0] == waiter):
+                    condition.wait((1 - scheduler["tokens"]) / scheduler["rate"])
+                else:
+                    condition.wait()
+
+            waited = time.monotonic() - started
+            stats = scheduler["stats"].setdefault(priority, {
+                "calls": 0,
+                "total_wait_seconds": 0.0,
+                "max_wait_seconds": 0.0
+            })
+            stats["calls"] += 1
+            stats["total_wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+    def scheduler_report():
+        report = {}
+        for scheduler in (llm_scheduler, tool_scheduler):
+            with scheduler["condition"]:
+                report[scheduler["name"]] = {
+                    "rate": scheduler["rate"],
+                    "burst": scheduler["burst"],
+                    "queued": len(scheduler["waiters"]),
+                    "priorities": {
+                        priority: dict(stats, average_wait_seconds=stats["total_wait_seconds"] / stats["calls"])
+                        for priority, stats in scheduler["stats"].items()
+                    }
+                }
+        return report
+
+    rate_limits = {
+        "llm": { "rate": 8, "burst": 8 },
+        "tools": { "rate": 8, "burst": 8 }
+    }
+    rate_limits.update(params.get("rate_limits", {}))
+    llm_scheduler = create_scheduler("llm", rate_limits["llm"])
+    tool_scheduler = create_scheduler("tools", rate_limits["tools"])
+
+    def acquire_quota(name, priority="normal"):
+        # Lets calls made outside generate share the service's quotas
+        acquire_slot({"llm": llm_scheduler, "tools": tool_scheduler}[name], priority)
+
+    def open_cassette(path, mode):
+        import gzip
+        if (path.endswith(".gz")):
+            return gzip.open(path, mode + "t", encoding="utf-8")
+        return open(path, mode, encoding="utf-8")
+
+    def cassette_key(kind, request):
+        import hashlib
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return kind + ":" + hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+    def load_cassette(path):
+        interactions = {}
+        with open_cassette(path, "r") as cassette_file:
+            for line in cassette_file:
+                if (line.strip()):
+                    interaction = json.loads(line)
+                    interactions.setdefault(interaction["key"], []).append(interaction)
+        return interactions
+
+    cassette = {
+        "lock": threading.Lock(),
+        "path": cassette_settings.get("path", "medbot_cassette.jsonl.gz"),
+        "interactions": {},
+        "positions": {},
+        "recorded_definitions": set()
+    }
+    if (cassette_mode == "replay"):
+        cassette["interactions"] = load_cassette(cassette["path"])
+
+    def record_interaction(kind, request, response, latency, offsets=None):
+        interaction = {
+            "key": cassette_key(kind, request),
+            "kind": kind,
+            "response": response,
+            "latency": round(latency, 4)
+        }
+        if (offsets is not None):
+            interaction["offsets"] = [round(offset, 4) for offset in offsets]
+        line = json.dumps(interaction, ensure_ascii=False, default=str) + "\n"
+        with cassette["lock"]:
+            with open_cassette(cassette["path"], "a") as cassette_file:
+                cassette_file.write(line)
+
+    def replay_interaction(kind, request):
+        key = cassette_key(kind, request)
+        with cassette["lock"]:
+            recorded = cassette["interactions"].get(key)
+            if (not recorded):
+                raise LookupError(f"No recorded {kind} interaction in {cassette['path']} for {json.dumps(request, default=str)[:200]}")
+            # Repeated identical calls are served in recording order, then the last one again
+            position = cassette["positions"].get(key, 0)
+            cassette["positions"][key] = position + 1
+            return recorded[min(position, len(recorded) - 1)]
+
+    def replay_delay(seconds):
+        latency = cassette_settings.get("latency")
+        if (latency == "recorded"):
+            time.sleep(seconds)
+        elif (isinstance(latency, (int, float)) and latency > 0):
+            time.sleep(seconds * latency)
+
+    def chat_request(model_id, messages, stop, kwargs):
+        # Ids are random per run, so they are left out of the match key
+        return {
+            "model": model_id,
+            "messages": [
+                {
+                    "type": message.type,
+                    "content": message.content,
+                    "tool_calls": [
+                        { "name": call["name"], "args": call["args"] }
+                        for call in (getattr(message, "tool_calls", None) or [])
+                    ]
+                }
+                for message in messages
+            ],
+            "tools": [tool.get("function", {}).get("name") for tool in kwargs.get("tools") or []],
+            "stop": stop
+        }
+
+    class ScheduledChatWatsonx(ChatWatsonx):
+        # Model calls may run on LangGraph worker threads
+        @profiled
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            from langchain_core.messages import message_to_dict, messages_from_dict
+            from langchain_core.outputs import ChatGeneration, ChatResult
+
+            request = chat_request(self.model_id, messages, stop, kwargs)
+            if (cassette_mode == "replay"):
+                interaction = replay_interaction("llm", request)
+                replay_delay(interaction["latency"])
+                response = interaction["response"]
+                return ChatResult(
+                    generations=[
+                        ChatGeneration(message=messages_from_dict([generation["message"]])[0], generation_info=generation["generation_info"])
+                        for generation in response["generations"]
+                    ],
+                    llm_output=response["llm_output"]
+                )
+
+            acquire_slot(llm_scheduler, current_priority())
+            started = time.monotonic()
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            if (cassette_mode == "record"):
+                record_interaction("llm", request, {
+                    "generations": [
+                        { "message": message_to_dict(generation.message), "generation_info": generation.generation_info }
+                        for generation in result.generations
+                    ],
+                    "llm_output": result.llm_output
+                }, time.monotonic() - started)
+            return result
+
+        @profiled
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            from langchain_core.messages import message_to_dict, messages_from_dict
+            from langchain_core.outputs import ChatGenerationChunk
+
+            request = chat_request(self.model_id, messages, stop, kwargs)
+            if (cassette_mode == "replay"):
+                interaction = replay_interaction("llm_stream", request)
+                previous = 0
+                for offset, chunk in zip(interaction["offsets"], interaction["response"]):
+                    replay_delay(offset - previous)
+                    previous = offset
+                    generation_chunk = ChatGenerationChunk(message=messages_from_dict([chunk["message"]])[0], generation_info=chunk["generation_info"])
+                    if (run_manager):
+                        run_manager.on_llm_new_token(generation_chunk.text, chunk=generation_chunk)
+                    yield generation_chunk
+                return
+
+            acquire_slot(llm_scheduler, current_priority())
+            started = time.monotonic()
+            chunks = []
+            offsets = []
+            for generation_chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                if (cassette_mode == "record"):
+                    chunks.append({ "message": message_to_dict(generation_chunk.message), "generation_info": generation_chunk.generation_info })
+                    offsets.append(time.monotonic() - started)
+                yield generation_chunk
+            if (cassette_mode == "record"):
+                record_interaction("llm_stream", request, chunks, time.monotonic() - started, offsets)
+
+    class CassetteTool(dict):
+        def __init__(self, tool_name, definition, tool):
+            super().__init__(definition)
+            self.tool_name = tool_name
+            self.tool = tool
+
+        def run(self, input, config):
+            request = { "tool": self.tool_name, "input": input, "config": config }
+            if (cassette_mode == "replay"):
+                interaction = replay_interaction("tool", request)
+                replay_delay(interaction["latency"])
+                return interaction["response"]
+            started = time.monotonic()
+            results = self.tool.run(input=input, config=config)
+            record_interaction("tool", request, results, time.monotonic() - started)
+            return results
+
+    def load_utility_tool(tool_name, api_client):
+        if (cassette_mode == "replay"):
+            definition = replay_interaction("tool_definition", { "tool": tool_name })["response"]
+            return CassetteTool(tool_name, definition, None)
+        utility_agent_tool = Toolkit(
+            api_client=api_client
+        ).get_tool(tool_name)
+        if (cassette_mode == "record"):
+            definition = { field: utility_agent_tool.get(field) for field in ("description", "agent_description", "input_schema") }
+            # Definitions are fetched for every pooled graph; one copy per tool is enough
+            if (tool_name not in cassette["recorded_definitions"]):
+                cassette["recorded_definitions"].add(tool_name)
+                record_interaction("tool_definition", { "tool": tool_name }, definition, 0)
+            return CassetteTool(tool_name, definition, utility_agent_tool)
+        return utility_agent_tool
+
+
+    def create_chat_model(watsonx_client, model_id=model, model_space_id=space_id, parameters=None):
+        if (parameters == None):
+            parameters = default_parameters
+
+        chat_model_settings = {
+            "model_id": model_id,
+            "url": service_url,
+            "space_id": model_space_id,
+            "params": parameters,
+            "watsonx_client": watsonx_client,
+        }
+        if (cassette_mode == "replay"):
+            # No validation, so no connection to watsonx is opened
+            return ScheduledChatWatsonx.model_construct(**chat_model_settings)
+        chat_model = ScheduledChatWatsonx(**chat_model_settings)
         return chat_model
     
     
     def create_utility_agent_tool(tool_name, params, api_client, **kwargs):
         from langchain_core.tools import StructuredTool
-        utility_agent_tool = Toolkit(
-            api_client=api_client
-        ).get_tool(tool_name)
+        utility_agent_tool = load_utility_tool(tool_name, api_client)
     
         tool_description = utility_agent_tool.get("description")
     
@@ -76,22 +607,63 @@ def gen_ai_service(context, params = params, **custom):
                 }
             }
         
-        def run_tool(**tool_input):
-            query = tool_input
-            if (utility_agent_tool.get("input_schema") == None):
-                query = tool_input.get("input")
-    
+        def execute_tool(query):
+            acquire_slot(tool_scheduler, current_priority())
             results = utility_agent_tool.run(
                 input=query,
                 config=params
             )
             
             return results.get("output")
+
+        def build_query(text):
+            if (utility_agent_tool.get("input_schema") == None):
+                return text
+            properties = tool_schema.get("properties", {})
+            field = (tool_schema.get("required") or list(properties) or ["input"])[0]
+            return { field: text }
+
+        runners = kwargs.get("runners")
+        if (runners is not None):
+            runners[tool_name] = (profiled(execute_tool), build_query)
+
+        def run_tool(**tool_input):
+            query = tool_input
+            if (utility_agent_tool.get("input_schema") == None):
+                query = tool_input.get("input")
+
+            key = prefetch_key(tool_name, query)
+            tool_cache = current_request().get("tool_cache")
+            if (tool_cache is not None):
+                with tool_cache["lock"]:
+                    cached = tool_cache["entries"].get(key)
+                    if (cached is not None):
+                        tool_cache["hits"] += 1
+                if (cached is not None):
+                    return compact_tool_output(tool_name, query, cached)
+
+            output = None
+            prefetched = current_request().get("prefetched")
+            if (prefetched is not None):
+                future = prefetched.pop(key, None)
+                if (future is not None):
+                    with prefetch_lock:
+                        prefetch_stats["hits"] += 1
+                    output = future.result()
+            if (output is None):
+                output = execute_tool(query)
+
+            if (tool_cache is not None):
+                with tool_cache["lock"]:
+                    tool_cache["entries"][key] = output
+                    while len(tool_cache["entries"]) > tool_cache["max_size"]:
+                        tool_cache["entries"].popitem(last=False)
+            return compact_tool_output(tool_name, query, output)
         
         return StructuredTool(
             name=tool_name,
             description = tool_description,
-            func=run_tool,
+            func=profiled(run_tool),
             args_schema=tool_schema
         )
     
@@ -121,28 +693,300 @@ def gen_ai_service(context, params = params, **custom):
         custom_tools = []
     
 
-    def create_tools(inner_client, context):
-        tools = []
-        
-        config = None
-        tools.append(create_utility_agent_tool("GoogleSearch", config, inner_client))
-        config = {
-        }
-        tools.append(create_utility_agent_tool("DuckDuckGo", config, inner_client))
-        config = {
+    tool_configs = {
+        "GoogleSearch": None,
+        "DuckDuckGo": {
+        },
+        "Wikipedia": {
             "maxResults": 5
+        },
+        "Weather": {
+        },
+        "WebCrawler": {
         }
-        tools.append(create_utility_agent_tool("Wikipedia", config, inner_client))
-        config = {
-        }
-        tools.append(create_utility_agent_tool("Weather", config, inner_client))
-        config = {
-        }
-        tools.append(create_utility_agent_tool("WebCrawler", config, inner_client))
+    }
+
+    # Token budgets for tool outputs kept in the prompt, per tool
+    tool_output_budgets = {
+        "GoogleSearch": 500,
+        "DuckDuckGo": 500,
+        "Wikipedia": 700,
+        "Weather": 300,
+        "WebCrawler": 800
+    }
+    tool_output_budgets.update(params.get("tool_output_budgets", {}))
+
+    boilerplate_pattern = re.compile(
+        r"cookie|privacy policy|terms of (use|service)|all rights reserved|sign in|log in|subscribe|newsletter"
+        r"|advertisement|skip to (main )?content|share this|follow us|accept all|javascript",
+        re.IGNORECASE
+    )
+
+    stop_words = set("""a an and are as at be by for from has have i in is it its of on or that the this to was were will with
+        my me you your what which who how can do does not no""".split())
+
+    compaction_lock = threading.Lock()
+    compaction_stats = {}
+
+    def estimate_tokens(text):
+        return (len(text) + 3) // 4
+
+    def tokenize(text):
+        return [word for word in re.findall(r"\w+", text.lower()) if word not in stop_words and len(word) > 1]
+
+    def strip_boilerplate(tool_name, text):
+        text = re.sub(r"<(script|style)[^>]*>.*?</\1>", " ", text, flags=re.IGNORECASE | re.DOTALL)
+        text = re.sub(r"<[^>]+>", " ", text)
+        lines = []
+        seen = set()
+        for line in text.splitlines():
+            line = " ".join(line.split())
+            if (not line or line in seen):
+                continue
+            if (len(line) < 160 and boilerplate_pattern.search(line)):
+                continue
+            # Crawled pages carry menus and link lists as short fragments
+            if (tool_name == "WebCrawler" and len(line.split()) < 4 and "IMAGE(" not in line):
+                continue
+            seen.add(line)
+            lines.append(line)
+        return lines
+
+    def chunk_lines(lines, words_per_chunk=80):
+        chunks = []
+        for line in lines:
+            words = line.split()
+            if (len(words) <= words_per_chunk):
+                chunks.append(line)
+                continue
+            sentences = re.split(r"(?<=[.!?])\s+", line)
+            current = []
+            for sentence in sentences:
+                if (current and len(" ".join(current).split()) + len(sentence.split()) > words_per_chunk):
+                    chunks.append(" ".join(current))
+                    current = []
+                current.append(sentence)
+            if (current):
+                chunks.append(" ".join(current))
+        return chunks
+
+    def rank_chunks(chunks, query_terms):
+        import math
+        chunk_terms = [tokenize(chunk) for chunk in chunks]
+        average_length = sum(len(terms) for terms in chunk_terms) / len(chunks) or 1
+        document_frequency = {}
+        for terms in chunk_terms:
+            for term in set(terms):
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        scores = []
+        for index, terms in enumerate(chunk_terms):
+            # BM25 against the user's symptoms and the tool query, with a small lead bonus
+            score = 1.0 / (index + 2)
+            for term in query_terms:
+                frequency = terms.count(term)
+                if (frequency):
+                    idf = math.log(1 + (len(chunks) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                    score += idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * len(terms) / average_length))
+            if ("IMAGE(" in chunks[index]):
+                score += 100
+            scores.append(score)
+        return scores
+
+    def record_compaction(tool_name, original, compacted):
+        with compaction_lock:
+            stats = compaction_stats.setdefault(tool_name, {
+                "calls": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "tokens_in": 0,
+                "tokens_out": 0
+            })
+            stats["calls"] += 1
+            stats["bytes_in"] += len(original.encode("utf-8"))
+            stats["bytes_out"] += len(compacted.encode("utf-8"))
+            stats["tokens_in"] += estimate_tokens(original)
+            stats["tokens_out"] += estimate_tokens(compacted)
+
+    def compact_tool_output(tool_name, query, output):
+        if (not isinstance(output, str)):
+            return output
+        if (params.get("compact_tool_outputs", True)):
+            output = extract_relevant_output(tool_name, query, output)
+        # Hard cap on what each tool message keeps in the graph state
+        max_chars = params.get("max_tool_output_chars", 8000)
+        if (len(output) > max_chars):
+            output = output[:max_chars] + "\n[truncated]"
+        return output
+
+    def extract_relevant_output(tool_name, query, output):
+        budget = tool_output_budgets.get(tool_name, 600)
+        lines = strip_boilerplate(tool_name, output)
+        compacted = "\n".join(lines)
+        if (estimate_tokens(compacted) > budget):
+            chunks = chunk_lines(lines)
+            query_text = json.dumps(query, ensure_ascii=False) + " " + current_request().get("user_text", "")
+            scores = rank_chunks(chunks, set(tokenize(query_text)))
+            selected = set()
+            used = 0
+            for index in sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True):
+                cost = estimate_tokens(chunks[index]) + 1
+                if (used + cost > budget):
+                    continue
+                selected.add(index)
+                used += cost
+            compacted = "\n".join(chunks[index] for index in sorted(selected))
+        record_compaction(tool_name, output, compacted)
+        return compacted
+
+    def compaction_report():
+        with compaction_lock:
+            report = {}
+            for tool_name, stats in compaction_stats.items():
+                report[tool_name] = dict(stats)
+                report[tool_name]["bytes_removed"] = stats["bytes_in"] - stats["bytes_out"]
+                report[tool_name]["tokens_removed"] = stats["tokens_in"] - stats["tokens_out"]
+            return report
+
+    def create_tools(inner_client, context, runners=None, tool_names=None):
+        tools = []
+        
+        # An empty subset is a tool-less graph, not "all tools"
+        for tool_name in (tool_configs if tool_names is None else tool_names):
+            config = tool_configs[tool_name]
+            tools.append(create_utility_agent_tool(tool_name, config, inner_client, runners=runners))
         return tools
+
+    symptom_terms = [
+        "chest pain", "shortness of breath", "difficulty breathing", "sore throat", "runny nose",
+        "stuffy nose", "abdominal pain", "stomach pain", "back pain", "joint pain", "muscle aches",
+        "ear pain", "itchy eyes", "loss of smell", "loss of taste", "headache", "migraine", "fever",
+        "cough", "nausea", "vomiting", "diarrhea", "constipation", "rash", "fatigue", "dizziness",
+        "chills", "sneezing", "congestion", "insomnia", "heartburn", "wheezing", "palpitations"
+    ]
+
+    # Lead phrases ignore case; every word of a place name must be capitalized
+    location_patterns = [
+        re.compile(r"\b(?i:i am|i'm|im) (?i:from|in|based in|located in|staying in)\s+([A-Z][\w\-]*(?:[ ,]+[A-Z][\w\-]*){0,3})"),
+        re.compile(r"\b(?i:i live in|living in|located in|my location is|my city is)\s+([A-Z][\w\-]*(?:[ ,]+[A-Z][\w\-]*){0,3})"),
+        re.compile(r"\b(?:from|in) ([A-Z][a-z]+(?:[ ,]+[A-Z][a-z]+){0,3})")
+    ]
+    non_location_words = {
+        "january", "february", "march", "april", "may", "june", "july", "august",
+        "september", "october", "november", "december",
+        "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+        "english", "spanish", "french", "german", "italian", "portuguese", "hindi", "arabic", "chinese", "japanese",
+        "i", "my", "me", "the", "a", "an", "this", "that", "these", "those", "our", "your", "his", "her", "their", "it"
+    }
+
+    def find_location(text):
+        for pattern in location_patterns:
+            for match in pattern.finditer(text):
+                parts = re.split(r"([ ,]+)", match.group(1).strip(" ,"))
+                kept = 0
+                while kept < len(parts) and parts[kept].lower() not in non_location_words:
+                    kept += 2
+                if (kept):
+                    return "".join(parts[:kept - 1])
+        return None
+
+    def extract_entities(messages):
+        text = last_user_text(messages)
+        if (not text):
+            return [], None
+        lowered = text.lower()
+        symptoms = []
+        for term in symptom_terms:
+            if (re.search(r"\b" + re.escape(term) + r"\b", lowered)
+                    and not any(term in found for found in symptoms)):
+                symptoms.append(term)
+        return symptoms, find_location(text)
+
+    # Symptom wording outside the lexicon still counts as a new description
+    symptom_cue_pattern = re.compile(r"\b(pain\w*|hurts?|ache\w*|aching|sore|swollen|swelling|itch\w*|bleed\w*|burning|numb\w*|tired|sick|ill|rash|lump|vomit\w*)\b", re.IGNORECASE)
+    url_pattern = re.compile(r"https?://\S+")
+    search_cue_pattern = re.compile(r"\b(search|look up|latest|news|outbreak\w*|advisor(y|ies)|cases|recent)\b", re.IGNORECASE)
+
+    tool_selection_lock = threading.Lock()
+    tool_selection_stats = {}
+
+    def select_tools(messages):
+        text = last_user_text(messages)
+        symptoms, location = extract_entities(messages)
+        has_symptoms = bool(symptoms) or bool(symptom_cue_pattern.search(text))
+        known_location = location or next(
+            (find_location(m["content"]) for m in reversed(messages)
+             if m.get("role") == "user" and isinstance(m.get("content"), str) and find_location(m["content"])),
+            None
+        )
+        is_follow_up = any(m.get("role") == "assistant" for m in messages)
+
+        selected = []
+        if (has_symptoms or not is_follow_up):
+            stage = "intake" if not is_follow_up else "new_symptoms"
+            selected += ["Wikipedia", "GoogleSearch"]
+        elif (location):
+            stage = "location_shared"
+            selected += ["GoogleSearch"]
+        else:
+            stage = "follow_up"
+        if (known_location and (has_symptoms or location)):
+            selected.append("Weather")
+        if (search_cue_pattern.search(text) and "GoogleSearch" not in selected):
+            selected += ["GoogleSearch", "DuckDuckGo"]
+        if (url_pattern.search(text)):
+            selected.append("WebCrawler")
+
+        tool_names = [name for name in tool_configs if name in selected]
+        with tool_selection_lock:
+            stage_stats = tool_selection_stats.setdefault(stage, {})
+            subset = ",".join(tool_names) or "(none)"
+            stage_stats[subset] = stage_stats.get(subset, 0) + 1
+        return tool_names
+
+    def tool_selection_report():
+        with tool_selection_lock:
+            return { stage: dict(counts) for stage, counts in tool_selection_stats.items() }
+
+    def prefetch_key(tool_name, query):
+        return tool_name + ":" + normalize_text(json.dumps(query, sort_keys=True, ensure_ascii=False))
+
+    def start_prefetch(runners, prefetched, messages):
+        if (not params.get("speculative_prefetch", True)):
+            return
+        symptoms, location = extract_entities(messages)
+        candidates = [("Wikipedia", symptom) for symptom in symptoms[:params.get("prefetch_max_symptoms", 2)]]
+        if (location):
+            candidates.append(("Weather", location))
+        for tool_name, text in candidates:
+            if (tool_name not in runners):
+                continue
+            execute_tool, build_query = runners[tool_name]
+            query = build_query(text)
+            key = prefetch_key(tool_name, query)
+            if (key in prefetched):
+                continue
+            # Run in a copy of the request context so the prefetch keeps its priority
+            prefetched[key] = prefetch_executor.submit(contextvars.copy_context().run, execute_tool, query)
+            with prefetch_lock:
+                prefetch_stats["issued"] += 1
+
+    def finish_prefetch(prefetched):
+        discarded = 0
+        while prefetched:
+            _, future = prefetched.popitem()
+            future.cancel()
+            discarded += 1
+        with prefetch_lock:
+            prefetch_stats["discarded"] += discarded
+
+    def prefetch_report():
+        with prefetch_lock:
+            report = dict(prefetch_stats)
+        report["hit_rate"] = report["hits"] / report["issued"] if report["issued"] else 0.0
+        return report
     
-    def create_agent(model, tools, messages):
-        memory = MemorySaver()
+    def build_instructions(messages):
         instructions = """# Notes
 - Use markdown syntax for formatting code snippets, links, JSON, tables, images, files.
 - Any HTML tags must be wrapped in block quotes, for example ```<html>```.
@@ -177,8 +1021,404 @@ When a user greets you, respond with a friendly and professional introduction li
         for message in messages:
             if message["role"] == "system":
                 instructions += message["content"]
-        graph = create_react_agent(model, tools=tools, checkpointer=memory, state_modifier=instructions)
+        return instructions
+
+    def apply_instructions(state):
+        instructions = current_request().get("instructions") or build_instructions([])
+        return [SystemMessage(content=instructions)] + state["messages"]
+
+    class BoundedMemorySaver(MemorySaver):
+        # A pooled graph is shared by concurrent requests; the lock serializes
+        # changes to the shared blob and write dicts with pruning and accounting
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.lock = threading.RLock()
+
+        def put(self, config, checkpoint, metadata, new_versions):
+            with profile_section(), self.lock:
+                saved_config = super().put(config, checkpoint, metadata, new_versions)
+                prune_checkpoints(self, saved_config["configurable"]["thread_id"], saved_config["configurable"]["checkpoint_ns"])
+            return saved_config
+
+        def put_writes(self, config, writes, task_id, task_path=""):
+            with profile_section(), self.lock:
+                super().put_writes(config, writes, task_id, task_path)
+
+        def delete_thread(self, thread_id):
+            with self.lock:
+                if (hasattr(MemorySaver, "delete_thread")):
+                    super().delete_thread(thread_id)
+                else:
+                    self.storage.pop(thread_id, None)
+
+    def prune_checkpoints(memory, thread_id, checkpoint_ns):
+        # Only the newest snapshots are needed to resume or read the final state
+        keep = params.get("max_checkpoints_per_thread", 4)
+        checkpoints = memory.storage[thread_id][checkpoint_ns]
+        if (len(checkpoints) <= keep):
+            return
+        for checkpoint_id in sorted(checkpoints)[:-keep]:
+            del checkpoints[checkpoint_id]
+            memory.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+        referenced = set()
+        for serialized, _, _ in checkpoints.values():
+            for channel, version in memory.serde.loads_typed(serialized)["channel_versions"].items():
+                referenced.add((thread_id, checkpoint_ns, channel, version))
+        for blob_key in [key for key in memory.blobs if key[:2] == (thread_id, checkpoint_ns) and key not in referenced]:
+            del memory.blobs[blob_key]
+
+    def create_agent(model, tools, messages):
+        memory = BoundedMemorySaver()
+        # Instructions are resolved per request so the compiled graph can be pooled
+        graph = create_react_agent(model, tools=tools, checkpointer=memory, state_modifier=apply_instructions)
         return graph
+
+    pool_lock = threading.Lock()
+    agent_pool = OrderedDict()
+    pool_stats = {
+        "hits": 0,
+        "misses": 0,
+        "evictions": 0
+    }
+
+    def resolve_agent_config(payload, headers):
+        parameters = dict(default_parameters)
+        parameters.update(payload.get("parameters") or {})
+        if ("tools" in payload):
+            tool_names = [name for name in payload["tools"] if name in tool_configs]
+        elif (params.get("dynamic_tools", True) and payload.get("messages")):
+            tool_names = select_tools(payload["messages"])
+        else:
+            tool_names = list(tool_configs)
+        return {
+            "space_id": payload.get("space_id") or (headers or {}).get("X-Space-Id") or space_id,
+            "model": payload.get("model") or model,
+            "parameters": parameters,
+            "tools": tool_names
+        }
+
+    def pool_key(agent_config):
+        return (
+            agent_config["space_id"],
+            agent_config["model"],
+            json.dumps(agent_config["parameters"], sort_keys=True),
+            tuple(sorted(agent_config["tools"]))
+        )
+
+    class RequestTokenAPIClient(APIClient):
+        # Pooled clients are shared, so each call authenticates with its own request's token
+        def _get_headers(self, *args, **kwargs):
+            token = current_request().get("token")
+            if (token is not None):
+                kwargs["_token"] = token
+            return super()._get_headers(*args, **kwargs)
+
+    def create_pool_entry(agent_config, token):
+        inner_client = None
+        if (cassette_mode != "replay"):
+            inner_client = RequestTokenAPIClient({
+                "url": service_url,
+                "token": token
+            })
+        chat_model = create_chat_model(inner_client, agent_config["model"], agent_config["space_id"], agent_config["parameters"])
+        runners = {}
+        tools = create_tools(inner_client, context, runners, agent_config["tools"])
+        now = time.monotonic()
+        return {
+            "config": agent_config,
+            "client": inner_client,
+            "model": chat_model,
+            "tools": tools,
+            "runners": runners,
+            "agent": create_agent(chat_model, tools, []),
+            "hits": 0,
+            "created": now,
+            "last_used": now
+        }
+
+    def acquire_agent(agent_config, token):
+        key = pool_key(agent_config)
+        with pool_lock:
+            entry = agent_pool.get(key)
+            if (entry is not None):
+                agent_pool.move_to_end(key)
+                entry["hits"] += 1
+                entry["last_used"] = time.monotonic()
+                pool_stats["hits"] += 1
+            else:
+                pool_stats["misses"] += 1
+        if (entry is not None):
+            return entry
+
+        entry = create_pool_entry(agent_config, token)
+        with pool_lock:
+            # Another request may have built the same entry meanwhile
+            entry = agent_pool.setdefault(key, entry)
+            agent_pool.move_to_end(key)
+            while len(agent_pool) > params.get("pool_size", 8):
+                agent_pool.popitem(last=False)
+                pool_stats["evictions"] += 1
+        return entry
+
+    def warm_pool(agent_configs, token=None):
+        for agent_config in agent_configs:
+            resolved = resolve_agent_config(agent_config, {})
+            acquire_agent(resolved, token or credentials["token"])
+
+    def release_thread(agent, thread_id):
+        agent.checkpointer.delete_thread(thread_id)
+        finish_conversation_thread(thread_id)
+
+    conversation_lock = threading.Lock()
+    conversations = OrderedDict()
+
+    def thread_memory(memory, thread_id):
+        checkpoint_bytes = 0
+        checkpoint_count = 0
+        with memory.lock:
+            for checkpoints in memory.storage.get(thread_id, {}).values():
+                checkpoint_count += len(checkpoints)
+                for serialized, metadata, _ in checkpoints.values():
+                    checkpoint_bytes += len(serialized[1]) + len(metadata[1])
+            blob_bytes = sum(len(blob[1]) for key, blob in memory.blobs.items() if key[0] == thread_id)
+            write_bytes = sum(
+                len(write[2][1])
+                for key, writes in memory.writes.items() if key[0] == thread_id
+                for write in writes.values()
+            )
+        return checkpoint_count, checkpoint_bytes + blob_bytes + write_bytes
+
+    def resolve_conversation_id(payload, headers, thread_id):
+        return str(payload.get("conversation_id") or (headers or {}).get("X-Conversation-Id") or thread_id)
+
+    def evict_idle_conversations():
+        idle_limit = params.get("conversation_idle_seconds", 900)
+        now = time.monotonic()
+        evicted = []
+        with conversation_lock:
+            for conversation_id, record in list(conversations.items()):
+                if (now - record["last_seen"] > idle_limit
+                        or len(conversations) > params.get("max_tracked_conversations", 1000)):
+                    evicted.append(conversations.pop(conversation_id))
+        # Threads still held here belong to abandoned requests (e.g. streams never closed)
+        for record in evicted:
+            for thread_id, agent in list(record["threads"].items()):
+                release_thread(agent, thread_id)
+
+    def start_conversation_thread(conversation_id, agent, thread_id, messages):
+        evict_idle_conversations()
+        with conversation_lock:
+            record = conversations.get(conversation_id)
+            if (record is None):
+                record = conversations[conversation_id] = {
+                    "threads": {},
+                    "requests": 0,
+                    "message_bytes": 0,
+                    "checkpoints": 0,
+                    "state_bytes": 0,
+                    "peak_state_bytes": 0,
+                    "last_seen": time.monotonic()
+                }
+            conversations.move_to_end(conversation_id)
+            record["threads"][thread_id] = agent
+            record["requests"] += 1
+            record["message_bytes"] = estimate_size(messages)
+            record["last_seen"] = time.monotonic()
+
+    def account_conversation_thread(agent, thread_id):
+        conversation_id = current_request().get("conversation_id")
+        checkpoint_count, state_bytes = thread_memory(agent.checkpointer, thread_id)
+        with conversation_lock:
+            record = conversations.get(conversation_id)
+            if (record is None):
+                return
+            record["checkpoints"] = checkpoint_count
+            record["state_bytes"] = state_bytes
+            record["peak_state_bytes"] = max(record["peak_state_bytes"], state_bytes)
+            record["last_seen"] = time.monotonic()
+
+    def finish_conversation_thread(thread_id):
+        with conversation_lock:
+            for record in conversations.values():
+                if (thread_id in record["threads"]):
+                    del record["threads"][thread_id]
+                    if (not record["threads"]):
+                        record["checkpoints"] = 0
+                        record["state_bytes"] = 0
+                    record["last_seen"] = time.monotonic()
+                    break
+
+    def process_rss():
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            return None
+
+    def memory_report(top=10):
+        evict_idle_conversations()
+        now = time.monotonic()
+        with conversation_lock:
+            records = [(conversation_id, dict(record, threads=len(record["threads"]))) for conversation_id, record in conversations.items()]
+        records.sort(key=lambda item: (item[1]["state_bytes"], item[1]["peak_state_bytes"]), reverse=True)
+        return {
+            "rss_bytes": process_rss(),
+            "conversations_tracked": len(records),
+            "active_threads": sum(record["threads"] for _, record in records),
+            "retained_state_bytes": sum(record["state_bytes"] for _, record in records),
+            "biggest_conversations": [
+                {
+                    "conversation_id": conversation_id,
+                    "active_threads": record["threads"],
+                    "requests": record["requests"],
+                    "message_bytes": record["message_bytes"],
+                    "checkpoints": record["checkpoints"],
+                    "state_bytes": record["state_bytes"],
+                    "peak_state_bytes": record["peak_state_bytes"],
+                    "idle_seconds": round(now - record["last_seen"], 3)
+                }
+                for conversation_id, record in records[:top]
+            ]
+        }
+
+    def estimate_size(obj):
+        # Approximate deep size; walked iteratively since graph objects nest deeply
+        seen = set()
+        pending = [obj]
+        size = 0
+        while pending:
+            item = pending.pop()
+            if (id(item) in seen or isinstance(item, (type, type(sys)))):
+                continue
+            seen.add(id(item))
+            size += sys.getsizeof(item, 0)
+            if (isinstance(item, dict)):
+                pending.extend(item.keys())
+                pending.extend(item.values())
+            elif (isinstance(item, (list, tuple, set, frozenset))):
+                pending.extend(item)
+            elif (isinstance(getattr(item, "__dict__", None), dict)):
+                pending.append(item.__dict__)
+        return size
+
+    def pool_report():
+        now = time.monotonic()
+        with pool_lock:
+            entries = list(agent_pool.values())
+            requests_seen = pool_stats["hits"] + pool_stats["misses"]
+            report = {
+                "size": len(entries),
+                "max_size": params.get("pool_size", 8),
+                "hit_rate": pool_stats["hits"] / requests_seen if requests_seen else 0.0,
+                **pool_stats
+            }
+        report["entries"] = [
+            {
+                "space_id": entry["config"]["space_id"],
+                "model": entry["config"]["model"],
+                "parameters": entry["config"]["parameters"],
+                "tools": [tool.name for tool in entry["tools"]],
+                "hits": entry["hits"],
+                "age_seconds": round(now - entry["created"], 3),
+                "idle_seconds": round(now - entry["last_used"], 3),
+                "memory_bytes": estimate_size({
+                    "tools": entry["tools"],
+                    "checkpoints": getattr(entry["agent"].checkpointer, "storage", {}),
+                    "writes": getattr(entry["agent"].checkpointer, "writes", {})
+                })
+            }
+            for entry in entries
+        ]
+        return report
+
+    default_sla = {
+        "deadline_seconds": 60,
+        "max_iterations": 6,
+        "token_budget": 24000,
+        "reserve_ratio": 0.15
+    }
+    default_sla.update(params.get("sla", {}))
+
+    sla_headers = {
+        "X-Sla-Deadline-Seconds": ("deadline_seconds", float),
+        "X-Sla-Max-Iterations": ("max_iterations", int),
+        "X-Sla-Token-Budget": ("token_budget", int)
+    }
+
+    forced_answer_note = """
+
+# Budget exhausted
+The time or research budget for this request has run out. Do not call any more tools. Using only the information gathered so far in this conversation, give your best complete answer now, and mention briefly if some details could not be verified."""
+
+    def resolve_sla(payload, headers):
+        sla = dict(default_sla)
+        sla.update(payload.get("sla") or {})
+        for header, (key, cast) in sla_headers.items():
+            value = headers.get(header) if headers else None
+            if (value is not None):
+                try:
+                    sla[key] = cast(value)
+                except ValueError:
+                    pass
+        return sla
+
+    def create_budget(sla):
+        return {
+            "sla": sla,
+            "started": time.monotonic(),
+            "iterations": 0,
+            "tokens": 0
+        }
+
+    def create_run_config(budget, thread_id):
+        # Backstop for the graph itself: each ReAct iteration is an agent step plus a tools step
+        return {
+            "configurable": { "thread_id": thread_id },
+            "recursion_limit": 2 * budget["sla"]["max_iterations"] + 2
+        }
+
+    def record_agent_step(budget, agent_message):
+        budget["iterations"] += 1
+        usage = getattr(agent_message, "usage_metadata", None) or {}
+        budget["tokens"] += usage.get("total_tokens", 0)
+
+    def budget_exhausted(budget):
+        sla = budget["sla"]
+        remaining = 1 - sla["reserve_ratio"]
+        elapsed = time.monotonic() - budget["started"]
+        if (budget["iterations"] >= sla["max_iterations"]):
+            return "max_iterations"
+        if (elapsed >= sla["deadline_seconds"] * remaining):
+            return "deadline"
+        if (budget["tokens"] >= sla["token_budget"] * remaining):
+            return "token_budget"
+        return None
+
+    def describe_stop(budget, reason):
+        return {
+            "reason": reason,
+            "iterations": budget["iterations"],
+            "elapsed_seconds": round(time.monotonic() - budget["started"], 3),
+            "total_tokens": budget["tokens"]
+        }
+
+    def build_forced_prompt(agent, config, messages):
+        state_messages = agent.get_state(config).values.get("messages", [])
+        answered = { m.tool_call_id for m in state_messages if isinstance(m, ToolMessage) }
+        # Drop tool requests the agent never got answers for
+        kept_messages = [
+            m for m in state_messages
+            if not (isinstance(m, AIMessage) and m.tool_calls
+                    and not all(call["id"] in answered for call in m.tool_calls))
+        ]
+        kept_ids = { call["id"] for m in kept_messages if isinstance(m, AIMessage) for call in m.tool_calls }
+        kept_messages = [m for m in kept_messages if not isinstance(m, ToolMessage) or m.tool_call_id in kept_ids]
+        return [SystemMessage(content=build_instructions(messages) + forced_answer_note)] + kept_messages
     
     def convert_messages(messages):
         converted_messages = []
@@ -189,26 +1429,221 @@ When a user greets you, respond with a friendly and professional introduction li
                 converted_messages.append(AIMessage(content=message["content"]))
         return converted_messages
 
+    canned_replies = {
+        "greeting": {
+            "en": "Hello! I'm MedBot, your AI-powered health assistant. I can help you understand your symptoms and guide you on what steps to take—backed by trusted medical sources. If you're comfortable, please share your location and describe your symptoms in your own words.",
+            "es": "¡Hola! Soy MedBot, tu asistente de salud con inteligencia artificial. Puedo ayudarte a entender tus síntomas y orientarte sobre los pasos a seguir, con el respaldo de fuentes médicas confiables. Si te sientes cómodo, comparte tu ubicación y describe tus síntomas con tus propias palabras.",
+            "fr": "Bonjour ! Je suis MedBot, votre assistant santé basé sur l'IA. Je peux vous aider à comprendre vos symptômes et vous orienter sur les démarches à suivre, en m'appuyant sur des sources médicales fiables. Si vous le souhaitez, indiquez votre localisation et décrivez vos symptômes avec vos propres mots.",
+            "de": "Hallo! Ich bin MedBot, Ihr KI-gestützter Gesundheitsassistent. Ich helfe Ihnen, Ihre Symptome zu verstehen, und zeige Ihnen, welche Schritte sinnvoll sind – gestützt auf vertrauenswürdige medizinische Quellen. Wenn Sie möchten, teilen Sie mir Ihren Standort mit und beschreiben Sie Ihre Symptome in eigenen Worten.",
+            "pt": "Olá! Eu sou o MedBot, seu assistente de saúde com inteligência artificial. Posso ajudar você a entender seus sintomas e orientar sobre os próximos passos, com base em fontes médicas confiáveis. Se estiver confortável, compartilhe sua localização e descreva seus sintomas com suas próprias palavras.",
+            "hi": "नमस्ते! मैं MedBot हूँ, आपका AI-आधारित स्वास्थ्य सहायक। मैं विश्वसनीय चिकित्सा स्रोतों के आधार पर आपके लक्षणों को समझने और आगे के कदम तय करने में आपकी मदद कर सकता हूँ। यदि आप सहज हों, तो कृपया अपना स्थान बताएं और अपने लक्षण अपने शब्दों में बताएं।"
+        },
+        "location_accept": {
+            "en": "Thank you! Please tell me your city or region, and describe your symptoms in your own words so I can check for relevant local health advisories.",
+            "es": "¡Gracias! Indícame tu ciudad o región y describe tus síntomas con tus propias palabras para que pueda revisar los avisos de salud locales relevantes.",
+            "fr": "Merci ! Indiquez-moi votre ville ou votre région et décrivez vos symptômes avec vos propres mots afin que je puisse vérifier les alertes sanitaires locales pertinentes.",
+            "de": "Danke! Nennen Sie mir bitte Ihre Stadt oder Region und beschreiben Sie Ihre Symptome in eigenen Worten, damit ich nach relevanten lokalen Gesundheitshinweisen suchen kann.",
+            "pt": "Obrigado! Informe sua cidade ou região e descreva seus sintomas com suas próprias palavras para que eu possa verificar alertas de saúde locais relevantes.",
+            "hi": "धन्यवाद! कृपया अपना शहर या क्षेत्र बताएं और अपने लक्षण अपने शब्दों में बताएं, ताकि मैं स्थानीय स्वास्थ्य सूचनाएँ देख सकूँ।"
+        },
+        "location_decline": {
+            "en": "No problem — sharing your location is completely optional. Please describe your symptoms in your own words and I'll do my best to help.",
+            "es": "No hay problema: compartir tu ubicación es totalmente opcional. Describe tus síntomas con tus propias palabras y haré lo posible por ayudarte.",
+            "fr": "Aucun problème : partager votre localisation est entièrement facultatif. Décrivez vos symptômes avec vos propres mots et je ferai de mon mieux pour vous aider.",
+            "de": "Kein Problem – die Angabe Ihres Standorts ist völlig freiwillig. Beschreiben Sie Ihre Symptome in eigenen Worten, und ich helfe Ihnen so gut ich kann.",
+            "pt": "Sem problemas — compartilhar sua localização é totalmente opcional. Descreva seus sintomas com suas próprias palavras e farei o possível para ajudar.",
+            "hi": "कोई बात नहीं — स्थान बताना पूरी तरह वैकल्पिक है। कृपया अपने लक्षण अपने शब्दों में बताएं, मैं आपकी पूरी मदद करने की कोशिश करूँगा।"
+        },
+        "thanks": {
+            "en": "You're welcome! If anything changes or you notice new symptoms, feel free to tell me. Take care!",
+            "es": "¡De nada! Si algo cambia o notas síntomas nuevos, no dudes en contármelo. ¡Cuídate!",
+            "fr": "Je vous en prie ! Si quelque chose change ou si de nouveaux symptômes apparaissent, n'hésitez pas à m'en parler. Prenez soin de vous !",
+            "de": "Gern geschehen! Wenn sich etwas ändert oder neue Symptome auftreten, sagen Sie mir gerne Bescheid. Passen Sie auf sich auf!",
+            "pt": "De nada! Se algo mudar ou você notar novos sintomas, fique à vontade para me contar. Cuide-se!",
+            "hi": "आपका स्वागत है! अगर कुछ बदलता है या नए लक्षण दिखते हैं, तो मुझे ज़रूर बताएं। अपना ध्यान रखें!"
+        },
+        "goodbye": {
+            "en": "Take care and feel better soon! Remember to consult a healthcare professional for serious or persistent symptoms.",
+            "es": "¡Cuídate y que te mejores pronto! Recuerda consultar a un profesional de la salud ante síntomas graves o persistentes.",
+            "fr": "Prenez soin de vous et bon rétablissement ! Consultez un professionnel de santé en cas de symptômes graves ou persistants.",
+            "de": "Alles Gute und gute Besserung! Wenden Sie sich bei ernsten oder anhaltenden Symptomen bitte an medizinisches Fachpersonal.",
+            "pt": "Cuide-se e melhoras! Lembre-se de consultar um profissional de saúde em caso de sintomas graves ou persistentes.",
+            "hi": "अपना ध्यान रखें और जल्दी ठीक हो जाएं! गंभीर या लगातार लक्षणों के लिए किसी स्वास्थ्य विशेषज्ञ से ज़रूर परामर्श लें।"
+        }
+    }
+
+    intent_phrases = {
+        "greeting": {
+            "en": ["hi", "hello", "hey", "hiya", "hi there", "hello there", "hey there", "hi medbot", "hello medbot", "hey medbot", "good morning", "good afternoon", "good evening", "greetings"],
+            "es": ["hola", "buenos dias", "buenas tardes", "buenas noches", "buenas", "hola medbot"],
+            "fr": ["bonjour", "salut", "bonsoir", "bonjour medbot"],
+            "de": ["hallo", "guten tag", "guten morgen", "guten abend", "servus", "hallo medbot"],
+            "pt": ["ola", "oi", "bom dia", "boa tarde", "boa noite", "ola medbot"],
+            "hi": ["namaste", "namaskar", "नमस्ते", "नमस्कार"]
+        },
+        "location_accept": {
+            "en": ["yes", "yeah", "yep", "sure", "ok", "okay", "of course", "yes sure", "yes i am", "i am comfortable", "yes i am comfortable", "sure thing"],
+            "es": ["si", "claro", "por supuesto", "si claro", "vale", "de acuerdo"],
+            "fr": ["oui", "bien sur", "d accord", "oui bien sur"],
+            "de": ["ja", "klar", "natürlich", "naturlich", "ja klar", "gerne"],
+            "pt": ["sim", "claro que sim", "pode ser", "com certeza"],
+            "hi": ["haan", "ha", "ji haan", "हाँ", "हां", "जी हाँ"]
+        },
+        "location_decline": {
+            "en": ["no", "nope", "no thanks", "no thank you", "i d rather not", "id rather not", "rather not", "not really", "i prefer not to", "no i am not"],
+            "es": ["no gracias", "prefiero no", "mejor no"],
+            "fr": ["non", "non merci", "je prefere pas", "je prefere ne pas"],
+            "de": ["nein", "nein danke", "lieber nicht"],
+            "pt": ["nao", "nao obrigado", "nao obrigada", "prefiro nao"],
+            "hi": ["nahi", "nahin", "नहीं"]
+        },
+        "thanks": {
+            "en": ["thanks", "thank you", "thanks a lot", "thank you so much", "thanks medbot", "thank you medbot", "thx", "ty"],
+            "es": ["gracias", "muchas gracias"],
+            "fr": ["merci", "merci beaucoup"],
+            "de": ["danke", "danke schon", "vielen dank"],
+            "pt": ["obrigado", "obrigada", "muito obrigado", "muito obrigada"],
+            "hi": ["dhanyavad", "shukriya", "धन्यवाद", "शुक्रिया"]
+        },
+        "goodbye": {
+            "en": ["bye", "goodbye", "bye bye", "see you", "see you later", "good night"],
+            "es": ["adios", "hasta luego", "chao"],
+            "fr": ["au revoir", "a bientot"],
+            "de": ["tschuss", "auf wiedersehen", "bis bald"],
+            "pt": ["tchau", "ate logo", "ate mais"],
+            "hi": ["alvida", "अलविदा"]
+        }
+    }
+
+    # Location consent replies are only canned when the assistant just asked for it
+    location_prompt_markers = ["location", "ubicación", "localisation", "standort", "localização", "स्थान"]
+    location_prompt_templates = {
+        reply for intent_name in ("greeting", "location_accept", "location_decline")
+        for reply in canned_replies[intent_name].values()
+    }
+
+    def normalize_text(text):
+        import unicodedata
+        import re
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn" or ord(ch) > 0x900)
+        text = unicodedata.normalize("NFC", text)
+        text = re.sub(r"[^\w\s]", " ", text)
+        return " ".join(text.split())
+
+    intent_lookup = {}
+    for intent_name, languages in intent_phrases.items():
+        for language, phrases in languages.items():
+            for phrase in phrases:
+                intent_lookup.setdefault(normalize_text(phrase), (intent_name, language))
+
+    def last_user_text(messages):
+        user_messages = [m["content"] for m in messages if m.get("role") == "user" and isinstance(m.get("content"), str)]
+        return user_messages[-1] if user_messages else ""
+
+    def detect_canned_intent(messages):
+        user_messages = [m for m in messages if m.get("role") == "user"]
+        if (not user_messages or not isinstance(user_messages[-1].get("content"), str)):
+            return None
+        match = intent_lookup.get(normalize_text(user_messages[-1]["content"]))
+        if (match is None):
+            return None
+        intent_name, language = match
+        if (intent_name in ("location_accept", "location_decline")):
+            previous = [m for m in messages if m.get("role") == "assistant"]
+            previous_content = previous[-1].get("content") if previous else ""
+            if (not is_location_prompt(previous_content)):
+                return None
+        return canned_replies[intent_name][language]
+
+    def is_location_prompt(content):
+        # A yes/no only answers the location question if nothing else was asked
+        if (not isinstance(content, str)):
+            return False
+        if (content in location_prompt_templates):
+            return True
+        mentions_location = lambda sentence: any(marker in sentence.lower() for marker in location_prompt_markers)
+        sentences = re.split(r"(?<=[.!?。])\s+", content.strip())
+        questions = [sentence for sentence in sentences if "?" in sentence or "¿" in sentence]
+        if (questions):
+            return all(mentions_location(sentence) for sentence in questions)
+        return any(mentions_location(sentence) for sentence in sentences)
+
     def generate(context):
         payload = context.get_json()
         messages = payload.get("messages")
-        inner_credentials = {
-            "url": service_url,
-            "token": context.get_token()
-        }
 
-        inner_client = APIClient(inner_credentials)
-        model = create_chat_model(inner_client)
-        tools = create_tools(inner_client, context)
-        agent = create_agent(model, tools, messages)
-        
-        generated_response = agent.invoke(
-            { "messages": convert_messages(messages) },
-            { "configurable": { "thread_id": "42" } }
-        )
+        canned_reply = detect_canned_intent(messages)
+        if (canned_reply is not None):
+            return {
+                "headers": {
+                    "Content-Type": "application/json"
+                },
+                "body": {
+                    "choices": [{
+                        "index": 0,
+                        "message": {
+                           "role": "assistant",
+                           "content": canned_reply
+                        }
+                    }]
+                }
+            }
 
-        last_message = generated_response["messages"][-1]
-        generated_response = last_message.content
+        red_flags = detect_red_flags(messages)
+
+        headers = context.get_headers()
+        entry = acquire_agent(resolve_agent_config(payload, headers), context.get_token())
+        model = entry["model"]
+        agent = entry["agent"]
+
+        budget = create_budget(resolve_sla(payload, headers))
+        thread_id = uuid.uuid4().hex
+        conversation_id = resolve_conversation_id(payload, headers, thread_id)
+        config = create_run_config(budget, thread_id)
+        generated_response = None
+        stop_reason = None
+        profile = start_profile("generate", conversation_id) if profile_requested(payload, headers) else None
+
+        prefetched = {}
+        request_token = request_context.set({
+            "instructions": build_instructions(messages),
+            "user_text": last_user_text(messages),
+            "priority": classify_priority(payload, messages),
+            "conversation_id": conversation_id,
+            "prefetched": prefetched,
+            "tool_cache": getattr(context, "tool_cache", None),
+            "token": context.get_token(),
+            "profile": profile
+        })
+        start_conversation_thread(conversation_id, agent, thread_id, messages)
+        start_prefetch(entry["runners"], prefetched, messages)
+        try:
+            with profile_section():
+                for update in agent.stream({ "messages": convert_messages(messages) }, config, stream_mode="updates"):
+                    account_conversation_thread(agent, thread_id)
+                    if ("agent" in update):
+                        agent_result = update["agent"]["messages"][0]
+                        record_agent_step(budget, agent_result)
+                        if (not agent_result.tool_calls):
+                            generated_response = agent_result.content
+                            continue
+                    reason = budget_exhausted(budget)
+                    if (reason):
+                        stop_reason = describe_stop(budget, reason)
+                        break
+                if (stop_reason):
+                    generated_response = model.invoke(build_forced_prompt(agent, config, messages)).content
+                elif (generated_response is None):
+                    generated_response = agent.get_state(config).values["messages"][-1].content
+        finally:
+            finish_prefetch(prefetched)
+            release_thread(agent, thread_id)
+            request_context.reset(request_token)
+            finish_profile(profile)
+
+        if (red_flags):
+            generated_response = red_flag_guidance(red_flags, red_flag_notice) + "\n\n" + generated_response
 
         execute_response = {
             "headers": {
@@ -224,6 +1659,10 @@ When a user greets you, respond with a friendly and professional introduction li
                 }]
             }
         }
+        if (stop_reason):
+            execute_response["body"]["stop_reason"] = stop_reason
+        if (profile is not None):
+            execute_response["headers"]["X-Profile-Id"] = profile["id"]
 
         return execute_response
 
@@ -233,25 +1672,103 @@ When a user greets you, respond with a friendly and professional introduction li
         headers = context.get_headers()
         is_assistant = headers.get("X-Ai-Interface") == "assistant"
         messages = payload.get("messages")
-        inner_credentials = {
-            "url": service_url,
-            "token": context.get_token()
+
+        canned_reply = detect_canned_intent(messages)
+        if (canned_reply is not None):
+            yield {
+                "choices": [{
+                    "index": 0,
+                    "delta": {
+                        "role": "assistant",
+                        "content": canned_reply
+                    }
+                }]
+            }
+            yield {
+                "choices": [{
+                    "index": 0,
+                    "delta": {
+                        "role": "assistant",
+                        "content": ""
+                    },
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "completion_tokens": 0,
+                    "prompt_tokens": 0,
+                    "total_tokens": 0
+                }
+            }
+            return
+
+        # Emergency guidance goes out before any remote call is made
+        red_flags = detect_red_flags(messages)
+        if (red_flags):
+            yield {
+                "choices": [{
+                    "index": 0,
+                    "delta": {
+                        "role": "assistant",
+                        "content": red_flag_guidance(red_flags, red_flag_notice) + "\n\n"
+                    }
+                }]
+            }
+
+        entry = acquire_agent(resolve_agent_config(payload, headers), context.get_token())
+        budget = create_budget(resolve_sla(payload, headers))
+        thread_id = uuid.uuid4().hex
+        conversation_id = resolve_conversation_id(payload, headers, thread_id)
+        profile = start_profile("generate_stream", conversation_id) if profile_requested(payload, headers) else None
+
+        prefetched = {}
+        request_state = {
+            "instructions": build_instructions(messages),
+            "user_text": last_user_text(messages),
+            "priority": classify_priority(payload, messages),
+            "conversation_id": conversation_id,
+            "prefetched": prefetched,
+            "token": context.get_token(),
+            "profile": profile
         }
-        inner_client = APIClient(inner_credentials)
-        model = create_chat_model(inner_client)
-        tools = create_tools(inner_client, context)
-        agent = create_agent(model, tools, messages)
+        start_conversation_thread(conversation_id, entry["agent"], thread_id, messages)
+        # Prefetches copy the current context, so it must hold this request's state
+        request_token = request_context.set(request_state)
+        try:
+            start_prefetch(entry["runners"], prefetched, messages)
+        finally:
+            request_context.reset(request_token)
+        try:
+            # Set around each step: a generator may resume in a different context
+            chunks = stream_agent_chunks(entry["agent"], entry["model"], messages, is_assistant, budget, thread_id)
+            while True:
+                request_token = request_context.set(request_state)
+                try:
+                    with profile_section():
+                        chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    request_context.reset(request_token)
+                yield chunk
+        finally:
+            finish_prefetch(prefetched)
+            release_thread(entry["agent"], thread_id)
+            finish_profile(profile)
 
+    def stream_agent_chunks(agent, model, messages, is_assistant, budget, thread_id):
+        config = create_run_config(budget, thread_id)
         response_stream = agent.stream(
             { "messages": messages },
-            { "configurable": { "thread_id": "42" } },
+            config,
             stream_mode=["updates", "messages"]
         )
 
+        stop_reason = None
         for chunk in response_stream:
             chunk_type = chunk[0]
             finish_reason = ""
             usage = None
+            check_budget = False
             if (chunk_type == "messages"):
                 message_object = chunk[1][0]
                 if (message_object.type == "AIMessageChunk" and message_object.content != ""):
@@ -264,10 +1781,12 @@ When a user greets you, respond with a friendly and professional introduction li
             elif (chunk_type == "updates"):
                 update = chunk[1]
                 if ("agent" in update):
-                    agent = update["agent"]
-                    agent_result = agent["messages"][0]
+                    agent_update = update["agent"]
+                    agent_result = agent_update["messages"][0]
+                    record_agent_step(budget, agent_result)
+                    check_budget = bool(agent_result.tool_calls)
                     if (agent_result.additional_kwargs):
-                        kwargs = agent["messages"][0].additional_kwargs
+                        kwargs = agent_update["messages"][0].additional_kwargs
                         tool_call = kwargs["tool_calls"][0]
                         if (is_assistant):
                             message = {
@@ -315,6 +1834,7 @@ When a user greets you, respond with a friendly and professional introduction li
                 elif ("tools" in update):
                     tools = update["tools"]
                     tool_result = tools["messages"][0]
+                    check_budget = True
                     if (is_assistant):
                         message = {
                             "role": "assistant",
@@ -349,4 +1869,226 @@ When a user greets you, respond with a friendly and professional introduction li
                 chunk_response["usage"] = usage
             yield chunk_response
 
+            if (check_budget):
+                account_conversation_thread(agent, thread_id)
+                reason = budget_exhausted(budget)
+                if (reason):
+                    stop_reason = describe_stop(budget, reason)
+                    break
+
+        if (stop_reason):
+            yield from stream_forced_answer(agent, model, messages, is_assistant, config, stop_reason)
+
+    def stream_forced_answer(agent, model, messages, is_assistant, config, stop_reason):
+        if (is_assistant):
+            message = {
+                "role": "assistant",
+                "step_details": {
+                    "type": "budget_exhausted",
+                    **stop_reason
+                }
+            }
+        else:
+            message = {
+                "role": "assistant",
+                "content": ""
+            }
+        yield {
+            "choices": [{
+                "index": 0,
+                "delta": message
+            }],
+            "stop_reason": stop_reason
+        }
+
+        final_chunk = None
+        for message_chunk in model.stream(build_forced_prompt(agent, config, messages)):
+            final_chunk = message_chunk if final_chunk is None else final_chunk + message_chunk
+            if (message_chunk.content):
+                yield {
+                    "choices": [{
+                        "index": 0,
+                        "delta": {
+                            "role": "assistant",
+                            "content": message_chunk.content
+                        }
+                    }]
+                }
+
+        chunk_response = {
+            "choices": [{
+                "index": 0,
+                "delta": {
+                    "role": "assistant",
+                    "content": ""
+                },
+                "finish_reason": (final_chunk.response_metadata.get("finish_reason") if final_chunk else None) or "stop"
+            }],
+            "stop_reason": stop_reason
+        }
+        usage_metadata = getattr(final_chunk, "usage_metadata", None)
+        if (usage_metadata):
+            chunk_response["usage"] = {
+                "completion_tokens": usage_metadata["output_tokens"],
+                "prompt_tokens": usage_metadata["input_tokens"],
+                "total_tokens": usage_metadata["total_tokens"]
+            }
+        yield chunk_response
+
+    class BatchItemContext:
+        def __init__(self, payload, headers, token, tool_cache):
+            self.payload = payload
+            self.headers = headers
+            self.token = token
+            self.tool_cache = tool_cache
+
+        def get_token(self):
+            return self.token
+
+        def get_json(self):
+            return self.payload
+
+        def get_headers(self):
+            return self.headers
+
+    def read_batch_items(conversations):
+        if (isinstance(conversations, str)):
+            with open(conversations, encoding="utf-8") as input_file:
+                conversations = [json.loads(line) for line in input_file if line.strip()]
+        for index, item in enumerate(conversations):
+            item_id = str(item.get("id", index))
+            yield item_id, item
+
+    def compact_batch_output(output_path):
+        # Keep one successful record per id; failed items are re-run, so their old
+        # error records and a record cut off by an interrupted run are dropped
+        completed = set()
+        if (not output_path or not os.path.exists(output_path)):
+            return completed
+        kept = []
+        with open(output_path, encoding="utf-8") as output_file:
+            for line in output_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if (record.get("status") == "ok" and str(record.get("id")) not in completed):
+                    completed.add(str(record.get("id")))
+                    kept.append(line if line.endswith("\n") else line + "\n")
+        with open(output_path + ".tmp", "w", encoding="utf-8") as output_file:
+            output_file.writelines(kept)
+        os.replace(output_path + ".tmp", output_path)
+        return completed
+
+    def run_batch_item(item_id, item, token, tool_cache):
+        payload = { key: value for key, value in item.items() if key not in ("id", "headers") }
+        payload.setdefault("priority", "background")
+        started = time.time()
+        record = {
+            "id": item_id,
+            "started_at": started
+        }
+        try:
+            item_token = token() if callable(token) else token
+            response = generate(BatchItemContext(payload, item.get("headers") or {}, item_token, tool_cache))
+            body = response["body"]
+            record["status"] = "ok"
+            record["content"] = body["choices"][0]["message"]["content"]
+            if (body.get("stop_reason")):
+                record["stop_reason"] = body["stop_reason"]
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["elapsed_seconds"] = round(time.time() - started, 3)
+        return record
+
+    batch_lock = threading.Lock()
+    batch_stats = {
+        "runs": 0,
+        "ok": 0,
+        "errors": 0,
+        "skipped": 0,
+        "tool_cache_hits": 0
+    }
+
+    def batch_report():
+        with batch_lock:
+            return dict(batch_stats)
+
+    # Offline runner, kept off the return tuple: the platform treats a returned
+    # generate_batch as its batch-job entry point with a different contract
+    def run_batch(conversations, output_path=None, concurrency=None, token=None, resume=True):
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        concurrency = concurrency or params.get("batch_concurrency", 4)
+        # A callable is asked for a token per item, so long runs outlive a token's expiry
+        token = token or context.generate_token
+        completed_ids = compact_batch_output(output_path) if resume else set()
+        tool_cache = {
+            "lock": threading.Lock(),
+            "entries": OrderedDict(),
+            "max_size": params.get("batch_tool_cache_size", 1024),
+            "hits": 0
+        }
+        output_file = open(output_path, "a" if resume else "w", encoding="utf-8") if output_path else None
+
+        items = read_batch_items(conversations)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = set()
+                exhausted = False
+                while pending or not exhausted:
+                    # Keep a bounded number of conversations in flight
+                    while not exhausted and len(pending) < concurrency * 2:
+                        next_item = next(items, None)
+                        if (next_item is None):
+                            exhausted = True
+                        elif (next_item[0] in completed_ids):
+                            with batch_lock:
+                                batch_stats["skipped"] += 1
+                        else:
+                            pending.add(executor.submit(run_batch_item, *next_item, token, tool_cache))
+                    if (not pending):
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record = future.result()
+                        with batch_lock:
+                            batch_stats["ok" if record["status"] == "ok" else "errors"] += 1
+                        if (output_file):
+                            output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                            output_file.flush()
+                        yield record
+        finally:
+            if (output_file):
+                output_file.close()
+            with batch_lock:
+                batch_stats["runs"] += 1
+                batch_stats["tool_cache_hits"] += tool_cache["hits"]
+
+    # Precompiled graph variants for the subsets select_tools picks most often
+    common_tool_subsets = params.get("common_tool_subsets", [
+        [],
+        ["GoogleSearch", "Wikipedia"],
+        ["GoogleSearch", "Wikipedia", "Weather"]
+    ])
+    if (params.get("dynamic_tools", True)):
+        warm_pool([{ "tools": subset } for subset in common_tool_subsets])
+    warm_pool(params.get("pool_warmup", []))
+
+    generate.prefetch_stats = prefetch_report
+    generate.pool_stats = pool_report
+    generate.warm_pool = warm_pool
+    generate.tool_output_stats = compaction_report
+    generate.compact_tool_output = compact_tool_output
+    generate.scheduler_stats = scheduler_report
+    generate.acquire_slot = acquire_quota
+    generate.tool_selection_stats = tool_selection_report
+    generate.select_tools = select_tools
+    generate.memory_stats = memory_report
+    generate.profiles = profile_report
+    generate.get_profile = get_profile
+    generate.run_batch = run_batch
+    generate.batch_stats = batch_report
+
     return generate, generate_stream
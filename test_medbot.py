@@ -5,9 +5,23 @@ This script creates a mock context and tests the medbot functionality
 """
 
 import json
-from unittest.mock import Mock, MagicMock
+import os
+import sys
+import threading
+import time
+from unittest.mock import Mock, MagicMock, patch
 from medbot import gen_ai_service
 
+# Synthetic traffic from a scripted stand-in model (cassettes/record_synthetic.py),
+# so agent code paths run offline; it says nothing about real watsonx responses
+CASSETTE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cassettes", "synthetic_sore_throat.jsonl")
+REPLAY_PARAMS = {
+    "space_id": "test-space",
+    "cassette": {"mode": "replay", "path": CASSETTE_PATH}
+}
+FOLLOW_UP_CASSETTE_PATH = os.path.join(os.path.dirname(CASSETTE_PATH), "synthetic_follow_up.jsonl")
+BUDGET_CASSETTE_PATH = os.path.join(os.path.dirname(CASSETTE_PATH), "synthetic_sore_throat_budget.jsonl")
+
 class MockContext:
     """Mock context object to simulate the IBM Watson context"""
     
@@ -143,6 +157,473 @@ def test_message_conversion():
         print(f"❌ Message conversion test failed: {e}")
         return False
 
+def test_canned_intents():
+    """Test that greetings and consent replies are answered without the agent"""
+    print("\n🧪 Testing canned intent fast path...")
+    try:
+        scenarios = [
+            ([{"role": "user", "content": "Hello!"}], "Hello! I'm MedBot"),
+            ([{"role": "user", "content": "Hola"}], "¡Hola! Soy MedBot"),
+            ([
+                {"role": "assistant", "content": "If you're comfortable, please share your location."},
+                {"role": "user", "content": "No thanks"}
+            ], "No problem"),
+        ]
+        for messages, expected in scenarios:
+            context = MockContext(test_messages=messages)
+            generate_func, generate_stream_func = gen_ai_service(context, params=REPLAY_PARAMS)
+
+            response = generate_func(context)
+            content = response["body"]["choices"][0]["message"]["content"]
+            assert content.startswith(expected), f"unexpected reply: {content}"
+
+            chunks = list(generate_stream_func(context))
+            assert chunks[0]["choices"][0]["delta"]["content"] == content, "stream reply differs"
+            assert chunks[-1]["choices"][0]["finish_reason"] == "stop", "stream not finished"
+        print("✅ Canned intents answered in the user's language")
+
+        # A yes/no to a mixed question is a clinical answer, not location consent
+        context = MockContext(test_messages=[
+            {"role": "assistant", "content": "Do you also have a cough? Sharing your location is optional."},
+            {"role": "user", "content": "no"}
+        ])
+        generate_func, _ = gen_ai_service(context, params=REPLAY_PARAMS)
+        try:
+            content = generate_func(context)["body"]["choices"][0]["message"]["content"]
+        except LookupError:
+            # The replay cassette has no agent run for this turn, so reaching it raises
+            content = None
+        assert content is None or not content.startswith("No problem"), "mixed question answered with a canned reply"
+        print("✅ Mixed questions go to the agent")
+        return True
+    except Exception as e:
+        print(f"❌ Canned intent test failed: {e}")
+        return False
+
+def test_batch_generation():
+    """Test batch generation output and resume using canned conversations"""
+    print("\n🧪 Testing batch generation...")
+    try:
+        import os
+        import tempfile
+
+        conversations = [
+            {"id": "greeting-en", "messages": [{"role": "user", "content": "Hi"}]},
+            {"id": "greeting-fr", "messages": [{"role": "user", "content": "Bonjour"}]},
+            {"id": "thanks-de", "messages": [{"role": "user", "content": "Danke"}]},
+            {"id": "unrecorded", "messages": [{"role": "user", "content": "My knee hurts after running"}]}
+        ]
+        context = MockContext()
+        generate_func, _ = gen_ai_service(context, params=REPLAY_PARAMS)
+        issued_tokens = []
+        def token_provider():
+            issued_tokens.append(f"token-{len(issued_tokens)}")
+            return issued_tokens[-1]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "results.jsonl")
+            records = list(generate_func.run_batch(conversations[:2] + conversations[3:], output_path=output_path, token=token_provider))
+            assert sorted(r["id"] for r in records) == ["greeting-en", "greeting-fr", "unrecorded"], "missing batch results"
+            assert all("elapsed_seconds" in r for r in records), "bad batch records"
+            assert {r["id"]: r["status"] for r in records}["unrecorded"] == "error", "replay miss not reported"
+            assert len(issued_tokens) == 3, "token provider not called per item"
+
+            # Simulate a run interrupted in the middle of writing a record
+            with open(output_path, "a", encoding="utf-8") as output_file:
+                output_file.write('{"id": "thanks-de", "sta')
+            resumed = list(generate_func.run_batch(conversations, output_path=output_path))
+            assert sorted(r["id"] for r in resumed) == ["thanks-de", "unrecorded"], "resume re-ran finished items"
+            with open(output_path, encoding="utf-8") as output_file:
+                lines = [json.loads(line) for line in output_file]
+            assert sorted(r["id"] for r in lines) == ["greeting-en", "greeting-fr", "thanks-de", "unrecorded"], "one record per id expected"
+        print("✅ Batch results written as JSONL and resumed")
+
+        stats = generate_func.batch_stats()
+        assert stats["runs"] == 2 and stats["ok"] == 3 and stats["errors"] == 2 and stats["skipped"] == 2, f"unexpected batch stats: {stats}"
+        print("✅ Batch outcomes reported through generate.batch_stats()")
+        return True
+    except Exception as e:
+        print(f"❌ Batch generation test failed: {e}")
+        return False
+
+def test_tool_output_compaction():
+    """Test that crawled pages are cut to the relevant chunks within budget"""
+    print("\n🧪 Testing tool output compaction...")
+    try:
+        params = dict(REPLAY_PARAMS, tool_output_budgets={"WebCrawler": 50})
+        generate_func, _ = gen_ai_service(MockContext(), params=params)
+
+        filler = [
+            "The museum gift shop sells postcards, mugs and prints from the spring exhibition every weekend.",
+            "Parking is available behind the main building, and the north entrance opens at nine each morning.",
+            "Our volunteers organise guided walks along the river path when the weather is good in summer.",
+            "The cafe on the second floor serves soup, sandwiches and cakes until half an hour before closing.",
+            "School groups can book workshops on local history by calling the education office in advance."
+        ]
+        page = "\n".join(
+            ["<html><script>var tracking = 1;</script>", "Home", "About us", "Accept all cookies to continue"]
+            + filler
+            + ["IMAGE(https://example.org/throat.png)",
+               "Strep throat symptoms include sudden sore throat, fever and swollen lymph nodes; it needs a test and antibiotics."]
+            + filler[::-1]
+            + ["All rights reserved</html>"]
+        )
+        compacted = generate_func.compact_tool_output("WebCrawler", "strep throat symptoms", page)
+
+        assert (len(compacted) + 3) // 4 <= 50, f"budget exceeded: {len(compacted)} chars"
+        assert "IMAGE(https://example.org/throat.png)" in compacted, "image line dropped"
+        assert "Strep throat symptoms include" in compacted, "relevant chunk dropped"
+        assert "gift shop" not in compacted and "cookies" not in compacted and "tracking" not in compacted, "filler kept over relevant text"
+        assert generate_func.tool_output_stats()["WebCrawler"]["tokens_removed"] > 0, "compaction not recorded"
+        print("✅ Relevant chunk and images kept within the token budget")
+        return True
+    except Exception as e:
+        print(f"❌ Tool output compaction test failed: {e}")
+        return False
+
+def test_red_flag_rules():
+    """Test the shared red-flag rules and their use in the mock responders"""
+    print("\n🧪 Testing red-flag rules...")
+    try:
+        from medbot import match_red_flags, red_flag_guidance
+        from interactive_test import create_mock_response
+
+        matches = match_red_flags("I have crushing chest pain and I can't breathe")
+        names = [rule["name"] for rule in matches]
+        assert names == ["chest_pain", "breathing_difficulty"], f"unexpected matches: {names}"
+        assert not match_red_flags("I have a mild sore throat"), "false positive on mild symptoms"
+        for text in [
+            "I hurt myself playing football and my ankle is swollen",
+            "I have a cough but no chest pain",
+            "I have a history of seizures",
+            "I fainted once years ago",
+            "No shortness of breath, just a runny nose",
+            "I do not have chest pain",
+            "I have never fainted",
+            "I'm not having any trouble breathing"
+        ]:
+            assert not match_red_flags(text), f"false positive: {text}"
+        for text, name in [
+            ("I've never had chest pain like this before", "chest_pain"),
+            ("I can not breathe", "breathing_difficulty"),
+            ("It's not just a headache, it's the worst headache of my life", "thunderclap_headache"),
+            ("I never thought I would have crushing pain", "chest_pain")
+        ]:
+            assert [rule["name"] for rule in match_red_flags(text)] == [name], f"red flag missed: {text}"
+        assert [rule["name"] for rule in match_red_flags("No fever, but crushing chest pain")] == ["chest_pain"], "negation leaked past the clause"
+        assert [rule["name"] for rule in match_red_flags("I keep thinking about hurting myself")] == ["self_harm"], "self-harm intent missed"
+        print("✅ Red-flag rules match urgent presentations only")
+
+        guidance = red_flag_guidance(match_red_flags("Sudden thunderclap headache"))
+        response = create_mock_response("Sudden thunderclap headache")
+        assert response.startswith(guidance), "mock responder does not lead with emergency guidance"
+        print("✅ Mock responder leads with shared emergency guidance")
+        return True
+    except Exception as e:
+        print(f"❌ Red-flag rule test failed: {e}")
+        return False
+
+def test_cassette_replay():
+    """Test the real generate/generate_stream paths against recorded traffic"""
+    print("\n🧪 Testing cassette replay...")
+    try:
+        context = MockContext(test_messages=[
+            {"role": "user", "content": "I have had a sore throat and a mild fever since yesterday"}
+        ])
+        generate_func, generate_stream_func = gen_ai_service(context, params=REPLAY_PARAMS)
+
+        content = generate_func(context)["body"]["choices"][0]["message"]["content"]
+        assert "Viral pharyngitis" in content, f"unexpected reply: {content[:80]}"
+        print("✅ generate replayed the recorded agent run")
+
+        chunks = list(generate_stream_func(context))
+        step = chunks[0]["choices"][0]["delta"]["step_details"]
+        assert step["type"] == "tool_calls" and step["tool_calls"][0]["name"] == "Wikipedia", "tool call not replayed"
+        streamed = "".join(c["choices"][0]["delta"].get("content") or "" for c in chunks)
+        assert streamed == content, "streamed answer differs from generate"
+        assert chunks[-1]["choices"][0]["finish_reason"] == "stop", "stream not finished"
+        print("✅ generate_stream replayed tool calls and the streamed answer")
+
+        stats = generate_func.prefetch_stats()
+        assert stats["issued"] >= stats["hits"] > 0 and 0 < stats["hit_rate"] <= 1, f"unexpected prefetch stats: {stats}"
+        print("✅ Prefetch hits reported through generate.prefetch_stats()")
+        return True
+    except Exception as e:
+        print(f"❌ Cassette replay test failed: {e}")
+        return False
+
+def test_tool_selection():
+    """Test which tools are bound for a new symptom versus a follow-up"""
+    print("\n🧪 Testing per-request tool selection...")
+    try:
+        first_turn = [{"role": "user", "content": "I have had a sore throat and a mild fever since yesterday"}]
+        context = MockContext(test_messages=first_turn)
+        params = dict(REPLAY_PARAMS, cassette={"mode": "replay", "path": FOLLOW_UP_CASSETTE_PATH})
+        generate_func, _ = gen_ai_service(context, params=params)
+
+        def run(messages):
+            # Entries differ only by tool set here; the pool reorders them on use
+            before = {tuple(entry["tools"]): entry["hits"] for entry in generate_func.pool_stats()["entries"]}
+            content = generate_func(MockContext(test_messages=messages))["body"]["choices"][0]["message"]["content"]
+            used = [
+                entry["tools"] for entry in generate_func.pool_stats()["entries"]
+                if entry["hits"] > before.get(tuple(entry["tools"]), 0)
+            ]
+            assert len(used) == 1, "request did not reuse exactly one pooled agent"
+            return used[0], content
+
+        tools, answer = run(first_turn)
+        assert tools == ["GoogleSearch", "Wikipedia"], f"new symptoms bound {tools}"
+        # Replay keys include the tool names sent to the model, so a follow-up
+        # that still carried tool schemas would find no recorded reply
+        tools, _ = run(first_turn + [
+            {"role": "assistant", "content": answer},
+            {"role": "user", "content": "How long will it usually last?"}
+        ])
+        assert tools == [], f"follow-up bound {tools}"
+        print("✅ New symptoms bind search tools, follow-ups bind none")
+
+        assert generate_func.tool_selection_stats()["follow_up"] == {"(none)": 1}, "follow-up stage not counted"
+        print("✅ Selected subsets counted per conversation stage")
+
+        # Weather is only bound for a real place name
+        for text in ["I live in constant pain", "i live in fear of getting sick", "I live in new york with a cough",
+                     "My fever started in January", "I have pain in My chest"]:
+            assert "Weather" not in generate_func.select_tools([{"role": "user", "content": text}]), f"location found in: {text}"
+        assert "Weather" in generate_func.select_tools([{"role": "user", "content": "I live in London and have a bad cough"}]), "location missed"
+        print("✅ Weather bound only when a place is named")
+        return True
+    except Exception as e:
+        print(f"❌ Tool selection test failed: {e}")
+        return False
+
+def test_budget_cutoff():
+    """Test the SLA cut-off and forced answer against recorded traffic"""
+    print("\n🧪 Testing budget cut-off...")
+    try:
+        context = MockContext(test_messages=[
+            {"role": "user", "content": "I have had a sore throat and a mild fever since yesterday"}
+        ])
+        context.headers = dict(context.headers, **{"X-Sla-Max-Iterations": "1"})
+        # The forced prompt is part of the replay key, so a prompt that still
+        # carried the unanswered Wikipedia call would find no recorded reply
+        params = dict(REPLAY_PARAMS, cassette={"mode": "replay", "path": BUDGET_CASSETTE_PATH})
+        generate_func, generate_stream_func = gen_ai_service(context, params=params)
+
+        body = generate_func(context)["body"]
+        assert body["stop_reason"]["reason"] == "max_iterations", f"unexpected stop: {body.get('stop_reason')}"
+        assert body["stop_reason"]["iterations"] == 1, "agent ran past its iteration budget"
+        assert "Viral pharyngitis" in body["choices"][0]["message"]["content"], "forced answer missing"
+        print("✅ generate stopped at the budget and forced an answer")
+
+        chunks = list(generate_stream_func(context))
+        steps = [c["choices"][0]["delta"].get("step_details", {}).get("type") for c in chunks]
+        assert "tool_response" not in steps, "tool ran after the budget was exhausted"
+        assert steps.index("budget_exhausted") == steps.index("tool_calls") + 1, f"unexpected steps: {steps}"
+        assert chunks[-1]["stop_reason"]["reason"] == "max_iterations", "stop reason not streamed"
+        streamed = "".join(c["choices"][0]["delta"].get("content") or "" for c in chunks)
+        assert streamed == body["choices"][0]["message"]["content"], "streamed forced answer differs"
+        print("✅ generate_stream reported budget_exhausted and streamed the forced answer")
+        return True
+    except Exception as e:
+        print(f"❌ Budget cut-off test failed: {e}")
+        return False
+
+def test_agent_pool():
+    """Test pooled agent reuse, LRU eviction and per-request authentication"""
+    print("\n🧪 Testing agent pool...")
+    try:
+        params = dict(REPLAY_PARAMS, dynamic_tools=False, pool_size=2)
+        generate_func, _ = gen_ai_service(MockContext(), params=params)
+        generate_func.warm_pool([{"tools": []}, {"tools": ["Wikipedia"]}, {"tools": []}, {"tools": ["Weather"]}])
+        stats = generate_func.pool_stats()
+        assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 3, 1), f"unexpected pool counts: {stats}"
+        assert stats["hit_rate"] == 0.25 and stats["size"] == 2, f"unexpected pool stats: {stats}"
+        assert [entry["tools"] for entry in stats["entries"]] == [[], ["Weather"]], "least recently used entry not evicted"
+        assert [entry["hits"] for entry in stats["entries"]] == [1, 0], "entry hits not counted"
+        print("✅ Least recently used agents evicted, hits counted in pool_stats()")
+
+        from cassettes.record_synthetic import SORE_THROAT, SyntheticAPIClient, SyntheticToolkit, ScriptedChatWatsonx
+
+        class HeaderAPIClient(SyntheticAPIClient):
+            def _get_headers(self, *args, _token=None, **kwargs):
+                return {"Authorization": f"Bearer {_token or self.credentials['token']}"}
+
+        # Both requests are held on the model call until the other one is in flight
+        in_flight = threading.Barrier(2, timeout=10)
+        sent = []
+
+        class HeaderRecordingChatWatsonx(ScriptedChatWatsonx):
+            def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+                in_flight.wait()
+                sent.append((messages[-1].content if len(messages) == 2 else None, self.watsonx_client._get_headers()["Authorization"]))
+                return super()._generate(messages, stop, run_manager, **kwargs)
+
+        with patch("ibm_watsonx_ai.APIClient", HeaderAPIClient), \
+                patch("ibm_watsonx_ai.foundation_models.utils.Toolkit", SyntheticToolkit), \
+                patch("langchain_ibm.ChatWatsonx", HeaderRecordingChatWatsonx):
+            generate_func, _ = gen_ai_service(MockContext(mock_token="startup-token"), params={"space_id": "test-space"})
+            contexts = {
+                "Bearer token-a": MockContext([{"role": "user", "content": SORE_THROAT}], mock_token="token-a"),
+                "Bearer token-b": MockContext([{"role": "user", "content": SORE_THROAT + " and a cough"}], mock_token="token-b")
+            }
+            errors = []
+            def run(context):
+                try:
+                    generate_func(context)
+                except Exception as e:
+                    errors.append(e)
+            workers = [threading.Thread(target=run, args=(context,)) for context in contexts.values()]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        assert not errors, f"pooled request failed: {errors[0]!r}"
+        assert len(generate_func.pool_stats()["entries"]) == 3 and generate_func.pool_stats()["misses"] == 3, "requests did not share a pooled agent"
+        first_calls = dict((authorization, text) for text, authorization in sent if text)
+        assert first_calls == {authorization: context.test_messages[0]["content"] for authorization, context in contexts.items()}, f"tokens crossed between requests: {sent}"
+        assert all(authorization != "Bearer startup-token" for _, authorization in sent), "pooled client used its creation token"
+        print("✅ Concurrent requests on one pooled agent send their own Authorization")
+        return True
+    except Exception as e:
+        print(f"❌ Agent pool test failed: {e}")
+        return False
+
+def test_scheduler():
+    """Test token-bucket pacing and urgent-first ordering of outbound calls"""
+    print("\n🧪 Testing call scheduler...")
+    try:
+        params = dict(REPLAY_PARAMS, cassette=dict(REPLAY_PARAMS["cassette"], pace=True),
+                      rate_limits={"llm": {"rate": 20, "burst": 1}})
+        generate_func, _ = gen_ai_service(MockContext(), params=params)
+
+        started = time.monotonic()
+        for _ in range(4):
+            generate_func.acquire_slot("llm")
+        elapsed = time.monotonic() - started
+        assert 0.15 - 0.02 <= elapsed < 1.0, f"calls not paced at 20/s: {elapsed:.3f}s"
+        print("✅ Calls paced by the token bucket")
+
+        # Queue three normal calls, then an urgent one behind them
+        order = []
+        def take(priority):
+            generate_func.acquire_slot("llm", priority)
+            order.append(priority)
+        def wait_for_queue(size):
+            deadline = time.monotonic() + 1
+            while generate_func.scheduler_stats()["llm"]["queued"] < size and time.monotonic() < deadline:
+                time.sleep(0.001)
+        generate_func.acquire_slot("llm")
+        workers = []
+        for priority in ["normal", "normal", "normal", "urgent"]:
+            workers.append(threading.Thread(target=take, args=(priority,)))
+            workers[-1].start()
+            wait_for_queue(len(workers))
+        for thread in workers:
+            thread.join()
+        assert order == ["urgent", "normal", "normal", "normal"], f"urgent call not served first: {order}"
+        print("✅ Urgent calls served before queued normal calls")
+
+        stats = generate_func.scheduler_stats()["llm"]["priorities"]
+        assert stats["normal"]["calls"] == 8 and stats["urgent"]["calls"] == 1, f"unexpected call counts: {stats}"
+        assert stats["urgent"]["max_wait_seconds"] < stats["normal"]["max_wait_seconds"], f"urgent waited longest: {stats}"
+        assert stats["normal"]["average_wait_seconds"] == stats["normal"]["total_wait_seconds"] / 8, "average wait miscomputed"
+        print("✅ Waits reported per priority")
+
+        unpaced, _ = gen_ai_service(MockContext(), params=dict(REPLAY_PARAMS, rate_limits={"llm": {"rate": 1, "burst": 1}}))
+        started = time.monotonic()
+        for _ in range(3):
+            unpaced.acquire_slot("llm")
+        assert time.monotonic() - started < 0.5, "replay paced without being asked"
+        print("✅ Replays skip pacing by default")
+        return True
+    except Exception as e:
+        print(f"❌ Scheduler test failed: {e}")
+        return False
+
+def test_memory_accounting():
+    """Test per-conversation memory accounting and bounded checkpoint history"""
+    print("\n🧪 Testing conversation memory accounting...")
+    try:
+        context = MockContext(test_messages=[
+            {"role": "user", "content": "I have had a sore throat and a mild fever since yesterday"}
+        ])
+        context.headers = dict(context.headers, **{"X-Conversation-Id": "conv-1"})
+        params = dict(REPLAY_PARAMS, max_checkpoints_per_thread=1)
+        generate_func, generate_stream_func = gen_ai_service(context, params=params)
+
+        stream = generate_stream_func(context)
+        next(stream)
+        next(stream)
+        conversation = generate_func.memory_stats()["biggest_conversations"][0]
+        assert conversation["conversation_id"] == "conv-1", "conversation id not taken from header"
+        assert conversation["active_threads"] == 1 and conversation["checkpoints"] == 1, f"history not bounded: {conversation}"
+        print("✅ Open stream accounted with a single retained checkpoint")
+
+        stream.close()
+        generate_func(context)
+        stats = generate_func.memory_stats()
+        conversation = stats["biggest_conversations"][0]
+        assert stats["active_threads"] == 0 and stats["retained_state_bytes"] == 0, "thread state not released"
+        assert conversation["requests"] == 2 and conversation["peak_state_bytes"] > 0, f"unexpected accounting: {conversation}"
+        print("✅ Thread state released when requests finish")
+
+        # Concurrent requests prune and measure one pooled checkpointer
+        errors = []
+        def worker():
+            try:
+                for _ in range(40):
+                    generate_func(context)
+                    generate_func.memory_stats()
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=worker) for _ in range(8)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # interleave threads often enough to expose races
+        try:
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert not errors, f"concurrent requests failed: {errors[0]!r}"
+        assert generate_func.memory_stats()["active_threads"] == 0, "thread state leaked under concurrency"
+        print("✅ Concurrent requests share the checkpointer safely")
+        return True
+    except Exception as e:
+        print(f"❌ Memory accounting test failed: {e}")
+        return False
+
+def test_profiling():
+    """Test per-request sampling profiles of replayed agent runs"""
+    print("\n🧪 Testing request profiling...")
+    try:
+        context = MockContext(test_messages=[
+            {"role": "user", "content": "I have had a sore throat and a mild fever since yesterday"}
+        ])
+        params = dict(REPLAY_PARAMS, profile_interval_ms=1)
+        generate_func, generate_stream_func = gen_ai_service(context, params=params)
+
+        response = generate_func(context)
+        assert "X-Profile-Id" not in response["headers"], "profiled without being requested"
+        assert generate_func.profiles() == [], "unexpected profile recorded"
+
+        context.headers = dict(context.headers, **{"X-Profile": "1"})
+        profile_id = generate_func(context)["headers"]["X-Profile-Id"]
+        list(generate_stream_func(context))
+        profiles = generate_func.profiles()
+        assert [p["mode"] for p in profiles] == ["generate_stream", "generate"], f"unexpected profiles: {profiles}"
+        assert profiles[1]["id"] == profile_id, "profile id header does not match"
+        for line in generate_func.get_profile(profile_id).splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert stack and int(count) > 0, f"not a collapsed stack line: {line}"
+        print("✅ Requested runs recorded as collapsed stacks")
+        return True
+    except Exception as e:
+        print(f"❌ Profiling test failed: {e}")
+        return False
+
 def run_all_tests():
     """Run all tests and provide summary"""
     print("🚀 Starting MedBot Test Suite")
@@ -152,7 +633,18 @@ def run_all_tests():
         ("Import Tests", test_imports),
         ("Function Definition Tests", test_function_definition),
         ("Mock Execution Tests", test_mock_execution),
-        ("Message Conversion Tests", test_message_conversion)
+        ("Message Conversion Tests", test_message_conversion),
+        ("Canned Intent Tests", test_canned_intents),
+        ("Batch Generation Tests", test_batch_generation),
+        ("Tool Output Compaction Tests", test_tool_output_compaction),
+        ("Red-Flag Rule Tests", test_red_flag_rules),
+        ("Cassette Replay Tests", test_cassette_replay),
+        ("Tool Selection Tests", test_tool_selection),
+        ("Budget Cut-off Tests", test_budget_cutoff),
+        ("Agent Pool Tests", test_agent_pool),
+        ("Scheduler Tests", test_scheduler),
+        ("Memory Accounting Tests", test_memory_accounting),
+        ("Profiling Tests", test_profiling)
     ]
     
     results = []
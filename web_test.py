@@ -6,18 +6,19 @@ This creates a simple web interface to test your MedBot service
 
 from flask import Flask, request, jsonify, render_template_string
 import json
+import os
 from unittest.mock import Mock
-from medbot import gen_ai_service
+from medbot import gen_ai_service, match_red_flags, red_flag_guidance, params
 
 app = Flask(__name__)
 
 class FlaskMockContext:
     """Mock context for Flask testing"""
     
-    def __init__(self, messages, token="test-token"):
+    def __init__(self, messages, token="test-token", headers=None):
         self.messages = messages
         self.token = token
-        self.headers = {"X-Ai-Interface": "assistant"}
+        self.headers = dict({"X-Ai-Interface": "assistant"}, **(headers or {}))
     
     def generate_token(self):
         return self.token
@@ -54,9 +55,9 @@ HTML_TEMPLATE = """
     <h1>🤖 MedBot Test Interface</h1>
     
     <div class="warning">
-        <strong>⚠️ This is a test interface with mock responses.</strong><br>
-        This simulates how MedBot would work with real IBM Watson integration.
-        Actual deployment would connect to IBM Watson services.
+        <strong>⚠️ This is a test interface.</strong><br>
+        Replies come from the MedBot service when it can start (set MEDBOT_CASSETTE to replay recorded traffic),
+        otherwise from canned mock responses.
     </div>
     
     <div class="chat-container" id="chatContainer">
@@ -127,6 +128,16 @@ HTML_TEMPLATE = """
 
 def generate_mock_response(message):
     """Generate mock medical responses"""
+    response = create_keyword_response(message)
+    
+    # Red flags use the same rules as the real service
+    red_flags = match_red_flags(message)
+    if red_flags:
+        return red_flag_guidance(red_flags) + "\n\n" + response
+    return response
+
+def create_keyword_response(message):
+    """Pick a canned response from keywords in the message"""
     message_lower = message.lower()
     
     if any(word in message_lower for word in ['hello', 'hi', 'hey', 'start']):
@@ -152,21 +163,74 @@ def index():
     """Serve the main chat interface"""
     return render_template_string(HTML_TEMPLATE)
 
+medbot_service = None
+
+def get_medbot_service():
+    """Create the MedBot service once and reuse it across requests"""
+    global medbot_service
+    if medbot_service is None:
+        service_params = dict(params)
+        if os.environ.get('MEDBOT_CASSETTE'):
+            service_params['cassette'] = {'mode': 'replay', 'path': os.environ['MEDBOT_CASSETTE']}
+        medbot_service = gen_ai_service(FlaskMockContext([]), params=service_params)
+    return medbot_service
+
+# Request headers passed through to the service (profiling, conversation accounting)
+FORWARDED_HEADERS = ['X-Profile', 'X-Conversation-Id']
+
 @app.route('/chat', methods=['POST'])
 def chat():
-    """Handle chat messages"""
+    """Handle chat messages with the shared service, so diagnostics see this traffic"""
     try:
         data = request.get_json()
         user_message = data.get('message', '')
-        
-        # Generate mock response
-        response = generate_mock_response(user_message)
-        
-        return jsonify({'response': response})
-        
     except Exception as e:
         return jsonify({'response': f'Sorry, I encountered an error: {str(e)}'})
 
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    try:
+        generate, _ = get_medbot_service()
+        result = generate(FlaskMockContext([{"role": "user", "content": user_message}], headers=headers))
+        body = {'response': result['body']['choices'][0]['message']['content']}
+        if 'X-Profile-Id' in result.get('headers', {}):
+            body['profile_id'] = result['headers']['X-Profile-Id']
+        return jsonify(body)
+    except Exception:
+        # Without credentials or a cassette the service cannot answer; fall back to canned replies
+        return jsonify({'response': generate_mock_response(user_message), 'mock': True})
+
+@app.route('/diagnostics/memory')
+def memory_diagnostics():
+    """Report process memory and the conversations holding the most state"""
+    try:
+        generate, _ = get_medbot_service()
+        top = request.args.get('top', 10, type=int)
+        return jsonify(generate.memory_stats(top=top))
+    except Exception as e:
+        return jsonify({'error': f'MedBot service unavailable: {str(e)}'}), 503
+
+@app.route('/diagnostics/profiles')
+def list_profiles():
+    """List recent sampling profiles (enable with the X-Profile header or profile_sample_rate)"""
+    try:
+        generate, _ = get_medbot_service()
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({'profiles': generate.profiles(limit=limit)})
+    except Exception as e:
+        return jsonify({'error': f'MedBot service unavailable: {str(e)}'}), 503
+
+@app.route('/diagnostics/profiles/<profile_id>')
+def get_profile(profile_id):
+    """Return one profile as collapsed stacks for flamegraph.pl or speedscope"""
+    try:
+        generate, _ = get_medbot_service()
+    except Exception as e:
+        return jsonify({'error': f'MedBot service unavailable: {str(e)}'}), 503
+    collapsed = generate.get_profile(profile_id)
+    if collapsed is None:
+        return jsonify({'error': f'Profile {profile_id} not found'}), 404
+    return collapsed + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""